@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+' Benchmark the calc1 ... calc6 interpreter generations '
+
+# usage: python bench.py [--count N] [--repeat N] [--seed N] [--json FILE]
+#
+# Every engine runs every generated workload its grammar can handle and
+# reports throughput, latency percentiles and peak memory, e.g.
+#
+#   engine          workload   evals/s    p50 us    p90 us    p99 us  peak KiB
+#   calc6-compiled  long          8123     118.2     125.0     160.3     41.2
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import time
+import tracemalloc
+
+import calc1
+import calc2
+import calc3
+import calc4
+import calc5
+import calc6
+
+
+def short_workload(rnd, count):
+    """'3 + 5': one operator between single digits, as read by calc1."""
+    return ['{0} {1} {2}'.format(rnd.randint(1, 9), rnd.choice('+-*/'), rnd.randint(1, 9))
+            for _ in range(count)]
+
+
+def long_workload(rnd, count, size=200):
+    """Long chains of multi-digit additions and subtractions."""
+    return [' '.join(['{0}'.format(rnd.randint(1, 999))] +
+                     ['{0} {1}'.format(rnd.choice('+-'), rnd.randint(1, 999)) for _ in range(size)])
+            for _ in range(count)]
+
+
+def operator_workload(rnd, count, size=100):
+    """Single digits joined by all four operators, no whitespace."""
+    return [''.join(['{0}'.format(rnd.randint(1, 9))] +
+                    ['{0}{1}'.format(rnd.choice('+-*/'), rnd.randint(1, 9)) for _ in range(size)])
+            for _ in range(count)]
+
+
+def nested_workload(rnd, count, depth=100):
+    """1 + (2 * (3 - (...))), nested depth levels deep."""
+    workload = []
+    for _ in range(count):
+        ops = [rnd.choice('+-*') for _ in range(depth)]
+        text = ''.join('{0} {1} ('.format(rnd.randint(1, 9), op) for op in ops)
+        workload.append(text + '1' + ')' * depth)
+    return workload
+
+
+WORKLOADS = [
+    ('short', short_workload),
+    ('long', long_workload),
+    ('operators', operator_workload),
+    ('nested', nested_workload),
+]
+
+# name, workloads the grammar accepts, evaluate(text)
+ENGINES = [
+    ('calc1', {'short'}, lambda text: calc1.Interpreter(text).expr()),
+    ('calc2', {'short'}, lambda text: calc2.Interpreter(text).expr()),
+    ('calc3', {'short', 'long', 'operators'}, lambda text: calc3.Interpreter(text).expr()),
+    ('calc4', {'short', 'long', 'operators'},
+     lambda text: calc4.Interpreter(calc4.Lexer(text)).expr()),
+    ('calc5', {'short', 'long', 'operators'},
+     lambda text: calc5.Interpreter(calc5.Lexer(text)).expr()),
+    ('calc6', {'short', 'long', 'operators', 'nested'},
+     lambda text: calc6.Interpreter(calc6.Lexer(text)).expr()),
+    ('calc6-compiled', {'short', 'long', 'operators', 'nested'},
+     lambda text: calc6.compile_expr(text).run()),
+    ('calc6-cached', {'short', 'long', 'operators', 'nested'},
+     lambda text: calc6.compile_cached(text).run()),
+]
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(evaluate, workload, repeat):
+    """Return throughput, latency percentiles (ns) and peak memory (bytes)."""
+    # one untimed pass so caches are warm and the first call pays nothing extra
+    for text in workload:
+        evaluate(text)
+
+    latencies = []
+    clock = time.perf_counter_ns
+    for _ in range(repeat):
+        for text in workload:
+            start = clock()
+            evaluate(text)
+            latencies.append(clock() - start)
+    latencies.sort()
+
+    # tracing slows everything down, so memory gets its own pass
+    tracemalloc.start()
+    for text in workload:
+        evaluate(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'evals_per_sec': len(latencies) * 1e9 / sum(latencies),
+        'p50_ns': percentile(latencies, 0.50),
+        'p90_ns': percentile(latencies, 0.90),
+        'p99_ns': percentile(latencies, 0.99),
+        'peak_bytes': peak,
+    }
+
+
+def run(count=200, repeat=5, seed=0):
+    workloads = dict((name, make(random.Random(seed), count)) for name, make in WORKLOADS)
+    results = []
+    # calc1 ... calc3 print their tokens while they work
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for engine, accepts, evaluate in ENGINES:
+            for workload, _ in WORKLOADS:
+                if workload not in accepts:
+                    continue
+                result = measure(evaluate, workloads[workload], repeat)
+                result.update(engine=engine, workload=workload)
+                results.append(result)
+    return results
+
+
+def report(results):
+    print('{0:<16}{1:<11}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+        'engine', 'workload', 'evals/s', 'p50 us', 'p90 us', 'p99 us', 'peak KiB'))
+    for r in results:
+        print('{0:<16}{1:<11}{2:>10.0f}{3:>10.1f}{4:>10.1f}{5:>10.1f}{6:>10.1f}'.format(
+            r['engine'], r['workload'], r['evals_per_sec'],
+            r['p50_ns'] / 1e3, r['p90_ns'] / 1e3, r['p99_ns'] / 1e3, r['peak_bytes'] / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=200, help='expressions per workload')
+    parser.add_argument('--repeat', type=int, default=5, help='timed passes over each workload')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated workloads')
+    parser.add_argument('--json', help='also write the raw results to this file')
+    args = parser.parse_args()
+
+    results = run(args.count, args.repeat, args.seed)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
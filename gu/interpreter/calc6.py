@@ -1,18 +1,170 @@
+import decimal
+import functools
+import itertools
+import math
+import mmap
+import operator
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+
 # Token types
 #
 # EOF (end-of-file) token is used to indicate that
 # there is no more input left for lexical analysis
 INTEGER, OPERATOR, EOF, SPACE = 'INTEGER', 'OPERATOR', 'EOF', "SPACE"
 LPAREN, RPAREN = '(', ')'
+ID = 'ID'
+ASSIGN = '='
+# an already parsed parenthesized group, only produced by Document
+GROUP = 'GROUP'
 #PRI1_OPLIST = ['MINUS','PLUS']
 #PRI2_OPLIST = ['MUL', 'DIV']
-PR1, PR2 = 'P1', 'P2'
+PR1, PR2, PR3 = 'P1', 'P2', 'P3'
 oplist1 = ['*', '/']
 oplist2 = ['+', '-']
+oplist3 = ['^']
+COMMA = ','
+
+# Opcodes of the compiled stack program
+LOAD_CONST, LOAD_NAME, BINARY_OP = 'LOAD_CONST', 'LOAD_NAME', 'BINARY_OP'
+UNARY_OP, CALL_FUNCTION = 'UNARY_OP', 'CALL_FUNCTION'
+
+# largest integer power, in bits, that ^ computes; 9^9^7 alone would
+# take seconds, 9^9^9 hours, also while constants are folded
+MAX_POWER_BITS = 1 << 20
+
+
+def _check_power(base, exponent):
+    """Raise OverflowError if base ** exponent would be an oversized int or Fraction."""
+    if type(exponent) is int and exponent > 0:
+        if type(base) is int:
+            size = abs(base).bit_length()
+        elif isinstance(base, Fraction):
+            size = max(abs(base.numerator).bit_length(), base.denominator.bit_length())
+        else:
+            return
+        # a lower bound: 3 ** n has more than n bits
+        if (size - 1) * exponent > MAX_POWER_BITS:
+            raise OverflowError('Result of ^ too large')
+
+
+def _pow(base, exponent):
+    _check_power(base, exponent)
+    result = base ** exponent
+    # as math.pow, instead of a complex root of a negative base
+    if type(result) is complex:
+        raise ValueError('Negative base with a fractional exponent')
+    return result
+
+
+BINARY_OPS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '^': _pow,
+}
+
+# a sign in front of an operand
+UNARY_OPS = {
+    '-': operator.neg,
+    '+': operator.pos,
+}
+
+
+class Function(object):
+    """A named function that expressions can call.
+
+    arity is the number of arguments, or None for one or more. vectorized
+    replaces fn when whole NumPy arrays are passed, as evaluate_columns()
+    does; without it fn gets the arrays. Calls of a pure function with
+    constant arguments are folded when compiling.
+    """
+
+    __slots__ = ('name', 'fn', 'arity', 'vectorized', 'pure')
+
+    def __init__(self, name, fn, arity=None, vectorized=None, pure=False):
+        self.name = name
+        self.fn = fn
+        self.arity = arity
+        self.vectorized = fn if vectorized is None else vectorized
+        self.pure = pure
+
+    def __repr__(self):
+        return '<Function {0}>'.format(self.name)
+
+
+def _min(*args):
+    return min(args)
+
+
+def _max(*args):
+    return max(args)
+
+
+def _vector_min(*args):
+    import numpy as np
+    return functools.reduce(np.minimum, args)
+
+
+def _vector_max(*args):
+    import numpy as np
+    return functools.reduce(np.maximum, args)
+
+
+def _vector_sqrt(value):
+    import numpy as np
+    return np.sqrt(value)
+
+
+# name -> Function, looked up once when an expression is compiled
+FUNCTIONS = dict((function.name, function) for function in (
+    Function('min', _min, None, _vector_min, pure=True),
+    Function('max', _max, None, _vector_max, pure=True),
+    Function('abs', abs, 1, pure=True),
+    Function('sqrt', math.sqrt, 1, _vector_sqrt, pure=True),
+))
+
+
+def register_function(name, fn, arity=None, vectorized=None, pure=False):
+    """Make fn callable as name(...) from expressions compiled from now on.
+
+    >>> register_function('clamp', lambda x, lo, hi: min(max(x, lo), hi), 3, pure=True)
+    >>> compile_expr('clamp(x, 0, 10)').run({'x': 12})
+    10
+    """
+    FUNCTIONS[name] = Function(name, fn, arity, vectorized, pure)
+    # cached Programs may have bound an earlier function of that name
+    expr_cache.clear()
+
+
+def lookup_function(name, count):
+    """Return the Function name, checking that it takes count arguments."""
+    function = FUNCTIONS.get(name)
+    if function is None:
+        raise Exception('Unknown function {0}'.format(name))
+    arity = function.arity
+    if arity is None and count == 0:
+        raise Exception('{0}() takes at least 1 argument'.format(name))
+    if arity is not None and count != arity:
+        raise Exception('{0}() takes {1} argument{2}, got {3}'.format(
+            name, arity, '' if arity == 1 else 's', count))
+    return function
 
 
 class Token(object):
 
+    # tokens are created by the ten thousand; no per-instance __dict__
+    __slots__ = ('type', 'value')
+
     def __init__(self, type, value):
         # token type: INTEGER, PLUS, or EOF
         self.type = type
@@ -62,6 +214,13 @@ class Lexer(object):
             self.advance()
         return int(result)
 
+    def identifier(self):
+        """Return a variable name consumed from the input."""
+        start = self.pos
+        while self.current_char is not None and (self.current_char.isalnum() or self.current_char == '_'):
+            self.advance()
+        return self.text[start:self.pos]
+
     def operator(self):
         """Return the operator from the input."""
         op = self.current_char
@@ -87,22 +246,173 @@ class Lexer(object):
             if self.current_char.isdigit():
                 return Token(INTEGER, self.integer())
 
+            if self.current_char.isalpha() or self.current_char == '_':
+                return Token(ID, self.identifier())
+
             if self.current_char in oplist1:
                 return Token(PR1, self.operator())
 
             if self.current_char in oplist2:
                 return Token(PR2, self.operator())
 
+            if self.current_char in oplist3:
+                return Token(PR3, self.operator())
+
             if self.current_char == LPAREN:
                 return Token(LPAREN, self.operator())
 
             if self.current_char == RPAREN:
                 return Token(RPAREN, self.operator())
 
+            if self.current_char == ASSIGN:
+                return Token(ASSIGN, self.operator())
+
+            if self.current_char == COMMA:
+                return Token(COMMA, self.operator())
+
             self.error()
 
         return Token(EOF, None)
 
+
+# one lexeme per match: a number, a name or any other single character
+_LEXEME_RE = re.compile(r'\d+|[^\W\d]\w*|\S')
+
+# compact type codes used by TokenStream; the last one marks an
+# invalid character
+TOKEN_TYPES = (EOF, INTEGER, ID, PR1, PR2, LPAREN, RPAREN, ASSIGN, PR3, COMMA, None)
+TOKEN_CODES = dict((type, code) for code, type in enumerate(TOKEN_TYPES))
+_INTEGER, _ID, _INVALID = TOKEN_CODES[INTEGER], TOKEN_CODES[ID], TOKEN_CODES[None]
+
+# type code of a lexeme, looked up by its first character
+_LEXEME_CODES = dict.fromkeys('0123456789', TOKEN_CODES[INTEGER])
+_LEXEME_CODES.update(dict.fromkeys(oplist1, TOKEN_CODES[PR1]))
+_LEXEME_CODES.update(dict.fromkeys(oplist2, TOKEN_CODES[PR2]))
+_LEXEME_CODES.update(dict.fromkeys(oplist3, TOKEN_CODES[PR3]))
+_LEXEME_CODES.update({LPAREN: TOKEN_CODES[LPAREN], RPAREN: TOKEN_CODES[RPAREN],
+                      ASSIGN: TOKEN_CODES[ASSIGN], COMMA: TOKEN_CODES[COMMA]})
+
+# operators, parentheses and EOF carry no per-occurrence data, so one
+# shared Token per value is handed out for all of them
+_SHARED_TOKENS = dict((char, Token(type, char))
+                      for chars, type in ((oplist1, PR1), (oplist2, PR2), (oplist3, PR3),
+                                          (LPAREN, LPAREN), (RPAREN, RPAREN),
+                                          (ASSIGN, ASSIGN), (COMMA, COMMA))
+                      for char in chars)
+_SHARED_TOKENS[None] = Token(EOF, None)
+
+
+class TokenStream(object):
+    """Tokens kept as parallel arrays instead of one object per token.
+
+    kinds holds one byte per token (an index into TOKEN_TYPES) and values
+    the token values; stream[i] builds a Token view on demand, e.g. for
+    error messages.
+    """
+
+    __slots__ = ('kinds', 'values')
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.values = []
+
+    def append(self, type, value):
+        self.kinds.append(TOKEN_CODES[type])
+        self.values.append(value)
+
+    def type(self, index):
+        return TOKEN_TYPES[self.kinds[index]]
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        return Token(TOKEN_TYPES[self.kinds[index]], self.values[index])
+
+    def __iter__(self):
+        for index in range(len(self.kinds)):
+            yield self[index]
+
+
+class RegexLexer(object):
+    """Table-driven drop-in replacement for Lexer.
+
+    The whole input is split into lexemes by one compiled regular
+    expression when the lexer is created; each lexeme is classified with
+    a single dict lookup and stored in a TokenStream. get_next_token()
+    then just walks the stream. An invalid character is reported when
+    the parser reaches it, as with Lexer.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.stream = stream = TokenStream()
+        add_kind = stream.kinds.append
+        add_value = stream.values.append
+        intern = sys.intern
+        code_of = _LEXEME_CODES.get
+        for lexeme in _LEXEME_RE.findall(text):
+            first = lexeme[0]
+            code = code_of(first)
+            if code == _INTEGER:
+                add_kind(code)
+                add_value(int(lexeme))
+            elif code is not None:
+                add_kind(code)
+                add_value(first)
+            elif first.isdigit():
+                # non-ASCII digits, as accepted by Lexer.integer()
+                add_kind(_INTEGER)
+                add_value(int(lexeme))
+            elif first.isalpha() or first == '_':
+                add_kind(_ID)
+                add_value(intern(lexeme))
+            else:
+                add_kind(_INVALID)
+                add_value(lexeme)
+        stream.append(EOF, None)
+        self.index = 0
+
+    def error(self):
+        raise Exception('Invalid character.')
+
+    def get_next_token(self):
+        index = self.index
+        stream = self.stream
+        code = stream.kinds[index]
+        if code == _INVALID:
+            self.error()
+        if index < len(stream.kinds) - 1:
+            self.index = index + 1
+        if code == _INTEGER or code == _ID:
+            return Token(TOKEN_TYPES[code], stream.values[index])
+        return _SHARED_TOKENS[stream.values[index]]
+
+
+def lex_spans(text, base=0):
+    """Tokenize text into parallel lists (types, values, starts, ends).
+
+    Offsets are counted from base; an invalid character gets the type
+    None.
+    """
+    kinds, values, starts, ends = [], [], [], []
+    for match in _LEXEME_RE.finditer(text):
+        lexeme = match.group()
+        code = _LEXEME_CODES.get(lexeme[0])
+        if code is None:
+            if lexeme[0].isdigit():
+                code = _INTEGER
+            elif lexeme[0].isalpha() or lexeme[0] == '_':
+                code = _ID
+            else:
+                code = _INVALID
+        kinds.append(TOKEN_TYPES[code])
+        values.append(int(lexeme) if code == _INTEGER else lexeme)
+        starts.append(base + match.start())
+        ends.append(base + match.end())
+    return kinds, values, starts, ends
+
+
 class Interpreter(object):
 
     def __init__(self, lexer):
@@ -125,28 +435,59 @@ class Interpreter(object):
             self.error()
 
     def factor(self):
-        """factor : INTEGER | LPAREN expr RPAREN"""
+        """factor : INTEGER | ID arguments | LPAREN expr RPAREN"""
         token = self.current_token
         if token.type == INTEGER:
             self.eat(INTEGER)
             return token.value
+        elif token.type == ID:
+            self.eat(ID)
+            args = self.arguments()
+            return lookup_function(token.value, len(args)).fn(*args)
         elif token.type == LPAREN:
             self.eat(LPAREN)
             result = self.expr()
             self.eat(RPAREN)
             return result
+        self.error()
 
-    def term(self):
-        """term : factor ((MUL | DIV) factor)*"""
+    def arguments(self):
+        """arguments : LPAREN (expr (COMMA expr)*)? RPAREN"""
+        self.eat(LPAREN)
+        args = []
+        if self.current_token.type != RPAREN:
+            args.append(self.expr())
+            while self.current_token.type == COMMA:
+                self.eat(COMMA)
+                args.append(self.expr())
+        self.eat(RPAREN)
+        return args
+
+    def power(self):
+        """power : factor (POW unary)?"""
         result = self.factor()
+        if self.current_token.type == PR3:
+            op = BINARY_OPS[self.current_token.value]
+            self.eat(PR3)
+            result = op(result, self.unary())
+        return result
+
+    def unary(self):
+        """unary : (PLUS | MINUS) unary | power"""
+        token = self.current_token
+        if token.type == PR2:
+            self.eat(PR2)
+            return UNARY_OPS[token.value](self.unary())
+        return self.power()
+
+    def term(self):
+        """term : unary ((MUL | DIV) unary)*"""
+        result = self.unary()
 
         while self.current_token.type == PR1:
-            op = self.current_token
+            op = BINARY_OPS[self.current_token.value]
             self.eat(PR1)
-            if op.value == '*':
-                result = result * self.factor()
-            elif op.value == '/':
-                result = result / self.factor()
+            result = op(result, self.unary())
 
         #print('term:{0}'.format(result))
         return result
@@ -157,23 +498,2182 @@ class Interpreter(object):
  
         calc> 7 + 3 * (10 / (12 / (3 + 1) - 1))
         22
+        calc> -2 ^ 2 + max(1, sqrt(16))
+        0.0
  
-        expr   : term ((PLUS | MINUS) term)*
-        term   : factor ((MUL | DIV) factor)*
-        factor : INTEGER | LPAREN expr RPAREN
+        expr      : term ((PLUS | MINUS) term)*
+        term      : unary ((MUL | DIV) unary)*
+        unary     : (PLUS | MINUS) unary | power
+        power     : factor (POW unary)?
+        factor    : INTEGER | ID arguments | LPAREN expr RPAREN
+        arguments : LPAREN (expr (COMMA expr)*)? RPAREN
+
+        Operators are looked up in BINARY_OPS and UNARY_OPS, functions
+        in FUNCTIONS.
         """
         result = self.term()
         while self.current_token.type == PR2 :
-            op = self.current_token
+            op = BINARY_OPS[self.current_token.value]
             self.eat(PR2)
-            if op.value == '+':
-                result = result + self.term()
-            elif op.value == '-':
-                result = result - self.term()
+            result = op(result, self.term())
  
         return result
 
+
+class AST(object):
+
+    def children(self):
+        return ()
+
+
+class Num(AST):
+
+    def __init__(self, token):
+        self.token = token
+        self.value = token.value
+
+
+class Var(AST):
+
+    def __init__(self, token):
+        self.token = token
+        self.name = token.value
+
+
+class BinOp(AST):
+
+    def __init__(self, left, op, right):
+        self.left = left
+        self.token = self.op = op
+        self.right = right
+
+    def children(self):
+        return (self.left, self.right)
+
+
+class UnaryOp(AST):
+
+    def __init__(self, op, expr):
+        self.token = self.op = op
+        self.expr = expr
+
+    def children(self):
+        return (self.expr,)
+
+
+class Call(AST):
+
+    def __init__(self, token, args):
+        self.token = token
+        self.name = token.value
+        self.args = args
+
+    def children(self):
+        return tuple(self.args)
+
+
+class Group(AST):
+    """A parenthesized expression kept as its own node.
+
+    Only Document builds these, so that the group can be parsed again
+    on its own and its parent picks up the new inner tree for free.
+    """
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.parent = None
+        # number of tokens from '(' to ')', both included
+        self.size = 0
+
+    def children(self):
+        return (self.inner,)
+
+
+class Parser(object):
+    """Build an AST from the token stream instead of evaluating it.
+
+    Same grammar as Interpreter.expr(), but the whole input must be
+    consumed and unexpected tokens are reported instead of being
+    turned into None.
+    """
+
+    def __init__(self, lexer):
+        self.lexer = lexer
+        self.current_token = self.lexer.get_next_token()
+
+    def error(self):
+        raise Exception('Invalid syntax. {0}'.format(self.current_token))
+
+    def eat(self, token_type):
+        if self.current_token.type == token_type:
+            self.current_token = self.lexer.get_next_token()
+        else:
+            self.error()
+
+    def factor(self):
+        """factor : INTEGER | ID | ID arguments | LPAREN expr RPAREN"""
+        token = self.current_token
+        if token.type == INTEGER:
+            self.eat(INTEGER)
+            return Num(token)
+        elif token.type == ID:
+            self.eat(ID)
+            if self.current_token.type == LPAREN:
+                return Call(token, self.arguments())
+            return Var(token)
+        elif token.type == LPAREN:
+            self.eat(LPAREN)
+            node = self.expr()
+            self.eat(RPAREN)
+            return node
+        self.error()
+
+    def arguments(self):
+        """arguments : LPAREN (expr (COMMA expr)*)? RPAREN"""
+        self.eat(LPAREN)
+        args = []
+        if self.current_token.type != RPAREN:
+            args.append(self.expr())
+            while self.current_token.type == COMMA:
+                self.eat(COMMA)
+                args.append(self.expr())
+        self.eat(RPAREN)
+        return args
+
+    def power(self):
+        """power : factor (POW unary)?"""
+        node = self.factor()
+        if self.current_token.type == PR3:
+            op = self.current_token
+            self.eat(PR3)
+            node = BinOp(node, op, self.unary())
+        return node
+
+    def unary(self):
+        """unary : (PLUS | MINUS) unary | power"""
+        token = self.current_token
+        if token.type == PR2:
+            self.eat(PR2)
+            return UnaryOp(token, self.unary())
+        return self.power()
+
+    def term(self):
+        """term : unary ((MUL | DIV) unary)*"""
+        node = self.unary()
+        while self.current_token.type == PR1:
+            op = self.current_token
+            self.eat(PR1)
+            node = BinOp(node, op, self.unary())
+        return node
+
+    def expr(self):
+        """expr : term ((PLUS | MINUS) term)*"""
+        node = self.term()
+        while self.current_token.type == PR2:
+            op = self.current_token
+            self.eat(PR2)
+            node = BinOp(node, op, self.term())
+        return node
+
+    def parse(self):
+        node = self.expr()
+        if self.current_token.type != EOF:
+            self.error()
+        return node
+
+
+# binding power of the binary operator token types; a sign binds
+# tighter than * and / but looser than ^, so -2^2 is -(2^2)
+PRECEDENCE = {PR2: 1, PR1: 2, PR3: 4}
+UNARY_PRECEDENCE = 3
+# 2^3^2 is 2^(3^2)
+RIGHT_ASSOCIATIVE = frozenset([PR3])
+
+
+class PrecedenceParser(object):
+    """Operator-precedence (shunting-yard) parser.
+
+    Builds the same AST as Parser, with the same errors, but keeps
+    pending operators and operands on explicit stacks instead of
+    recursing once per parenthesis, so nesting depth is limited by
+    memory only.
+    """
+
+    def __init__(self, lexer):
+        self.lexer = lexer
+        self.current_token = self.lexer.get_next_token()
+
+    def error(self):
+        raise Exception('Invalid syntax. {0}'.format(self.current_token))
+
+    def parse(self):
+        get_next_token = self.lexer.get_next_token
+        operands = []
+        # (precedence, node class, token, operand count) per pending
+        # operator; '(' and the '(' of a call have precedence 0, a call
+        # also notes where its arguments start on the operand stack
+        operators = []
+
+        def reduce():
+            _, kind, op, _ = operators.pop()
+            if kind is UnaryOp:
+                operands[-1] = UnaryOp(op, operands[-1])
+            else:
+                right = operands.pop()
+                operands[-1] = BinOp(operands[-1], op, right)
+
+        expect_operand = True
+        while True:
+            token = self.current_token
+            type = token.type
+            if expect_operand:
+                if type == INTEGER:
+                    operands.append(Num(token))
+                    expect_operand = False
+                elif type == ID:
+                    # a name followed by '(' is a call
+                    self.current_token = get_next_token()
+                    if self.current_token.type == LPAREN:
+                        operators.append((0, Call, token, len(operands)))
+                    else:
+                        operands.append(Var(token))
+                        expect_operand = False
+                        continue
+                elif type == GROUP:
+                    operands.append(token.value)
+                    expect_operand = False
+                elif type == LPAREN:
+                    operators.append((0, Group, token, None))
+                elif type == PR2:
+                    operators.append((UNARY_PRECEDENCE, UnaryOp, token, None))
+                elif type == RPAREN and operators and operators[-1][1] is Call \
+                        and operators[-1][3] == len(operands):
+                    # a call without arguments
+                    operands.append(Call(operators.pop()[2], []))
+                    expect_operand = False
+                else:
+                    self.error()
+            elif type in PRECEDENCE:
+                precedence = PRECEDENCE[type]
+                if type in RIGHT_ASSOCIATIVE:
+                    precedence += 1
+                while operators and operators[-1][0] >= precedence:
+                    reduce()
+                operators.append((PRECEDENCE[type], BinOp, token, None))
+                expect_operand = True
+            elif type == RPAREN or type == COMMA:
+                while operators and operators[-1][0]:
+                    reduce()
+                if not operators or (type == COMMA and operators[-1][1] is not Call):
+                    self.error()
+                if type == COMMA:
+                    expect_operand = True
+                else:
+                    _, kind, name, start = operators.pop()
+                    if kind is Call:
+                        args = operands[start:]
+                        del operands[start:]
+                        operands.append(Call(name, args))
+            elif type == EOF:
+                while operators and operators[-1][0]:
+                    reduce()
+                if operators:
+                    self.error()
+                return operands[0]
+            else:
+                self.error()
+            self.current_token = get_next_token()
+
+
+class NodeVisitor(object):
+    """Bottom-up tree walk with an explicit stack.
+
+    visit_<Class>(node, *results) is called once the results for all of
+    node.children() are known, so deep trees never hit the recursion
+    limit.
+    """
+
+    def visit(self, tree):
+        results = []
+        stack = [(tree, False)]
+        while stack:
+            node, ready = stack.pop()
+            children = node.children()
+            if ready or not children:
+                count = len(children)
+                args = results[len(results) - count:]
+                del results[len(results) - count:]
+                method_name = 'visit_' + type(node).__name__
+                visitor = getattr(self, method_name, self.generic_visit)
+                results.append(visitor(node, *args))
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(children))
+        return results[0]
+
+    def generic_visit(self, node, *args):
+        raise Exception('No visit_{0} method'.format(type(node).__name__))
+
+
+def uses_operator(tree, ops):
+    """True if any of the binary operators ops appears in tree."""
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, BinOp) and node.op.value in ops:
+            return True
+        pending.extend(node.children())
+    return False
+
+
+class NumericMode(object):
+    """How numbers are represented and combined.
+
+    A mode is picked once, when an expression is compiled: its constants
+    are converted by const(), its operators are looked up in ops and
+    unary and its functions by function(), so running the Program never
+    checks the mode again.
+    """
+
+    def __init__(self, name, ops, const=None, reassociate=True, unary=UNARY_OPS, functions=None,
+                 identities=True):
+        self.name = name
+        self.ops = ops
+        self.unary = unary
+        self.const = const
+        # whether x + 2 + 3 may be rewritten as x + 5
+        self.reassociate = reassociate
+        # whether x + 0, x - 0 and x * 1 may be rewritten as x
+        self.identities = identities
+        # name -> Function replacing the one in FUNCTIONS, None for a
+        # function the mode cannot compute
+        self.functions = functions or {}
+
+    def function(self, name, count):
+        """Return the Function name(...) calls in this mode; see lookup_function()."""
+        function = lookup_function(name, count)
+        if name in self.functions:
+            function = self.functions[name]
+            if function is None:
+                raise Exception('{0}() is not supported in {1} mode'.format(name, self.name))
+        return function
+
+    def bind(self, tree):
+        """Return the mode that tree is actually compiled with."""
+        return self
+
+    def __repr__(self):
+        return '<NumericMode {0}>'.format(self.name)
+
+
+class IntMode(NumericMode):
+    """Machine ints only; division is rejected when compiling."""
+
+    def bind(self, tree):
+        if uses_operator(tree, ('/',)):
+            raise Exception('Division is not supported in int mode')
+        return self
+
+
+class ExactMode(NumericMode):
+    """Exact results: ints while there is no division or power, Fraction otherwise."""
+
+    def bind(self, tree):
+        return FRACTION if uses_operator(tree, ('/', '^')) else INT
+
+
+class DecimalMode(NumericMode):
+    """decimal.Decimal arithmetic under one fixed context.
+
+    Every operation rounds to the context, so constants are never
+    regrouped and x + 0 or x * 1 are not dropped: they round x.
+    """
+
+    def __init__(self, context=None, **kw):
+        if context is None:
+            context = decimal.Context(**kw)
+        self.context = context
+        ops = {
+            '+': context.add,
+            '-': context.subtract,
+            '*': context.multiply,
+            '/': context.divide,
+            '^': context.power,
+        }
+        unary = {'-': context.minus, '+': context.plus}
+        functions = {
+            'abs': Function('abs', context.abs, 1, pure=True),
+            'sqrt': Function('sqrt', context.sqrt, 1, pure=True),
+        }
+        super(DecimalMode, self).__init__('decimal', ops, context.create_decimal, reassociate=False,
+                                          unary=unary, functions=functions, identities=False)
+
+
+def _fraction_div(left, right):
+    return Fraction(left) / right
+
+
+def _fraction_pow(base, exponent):
+    exponent = Fraction(exponent)
+    if exponent.denominator != 1:
+        # Fraction would fall back to a float power
+        raise ValueError('Fractional exponent in fraction mode')
+    base, exponent = Fraction(base), exponent.numerator
+    # 1 / base ** n is as large as base ** n
+    _check_power(base, abs(exponent))
+    return base ** exponent
+
+
+def _int_pow(base, exponent):
+    if exponent < 0:
+        raise ValueError('Negative exponent in int mode')
+    _check_power(base, exponent)
+    return base ** exponent
+
+
+# float is today's behaviour: ints until a '/' turns them into floats.
+# Variables may hold floats, and (x + 1) + 1 rounds differently from
+# x + 2, so constants are not regrouped; -0.0 + 0 is 0.0, so x + 0 is
+# not x.
+FLOAT = NumericMode('float', BINARY_OPS, reassociate=False, identities=False)
+# float results would pass for exact ones
+_EXACT_FUNCTIONS = {'sqrt': None}
+INT = IntMode('int', dict((op, fn) for op, fn in BINARY_OPS.items() if op != '/'),
+              functions=_EXACT_FUNCTIONS)
+INT.ops['^'] = _int_pow
+FRACTION = NumericMode('fraction', dict(BINARY_OPS, **{'/': _fraction_div, '^': _fraction_pow}),
+                       Fraction, functions=_EXACT_FUNCTIONS)
+EXACT = ExactMode('exact', None)
+
+
+class Optimizer(NodeVisitor):
+    """Rewrite an AST so that less work is left for run time.
+
+    - constant subtrees are folded: 12 / (3 + 1) - 1 becomes 2.0, which
+      also hoists everything that does not depend on a variable out of
+      the per-run work
+    - in int and fraction mode, integer identities are dropped: x * 1,
+      1 * x, x + 0, 0 + x, x - 0
+    - in modes with exact arithmetic (int, fraction), integer constants
+      are regrouped through + and * chains, so that x + 2 + 3 becomes
+      x + 5
+
+    Folding uses the operators of mode, so constants come out as the
+    mode's numbers. Calls of pure functions with constant arguments are
+    folded too. Division by zero and other failing operations are never
+    folded; they are left to fail at run time.
+    """
+
+    def __init__(self, mode=FLOAT):
+        self.mode = mode
+        self.ops = mode.ops
+        self.unary = mode.unary
+        self.reassociate = mode.reassociate
+        self.identities = mode.identities
+
+    def visit_Num(self, node):
+        return node
+
+    def visit_Var(self, node):
+        return node
+
+    def visit_Group(self, node, inner):
+        return inner
+
+    def visit_UnaryOp(self, node, operand):
+        if isinstance(operand, Num):
+            try:
+                return Num(Token(INTEGER, self.unary[node.op.value](operand.value)))
+            except ArithmeticError:
+                pass
+        if operand is node.expr:
+            return node
+        return UnaryOp(node.op, operand)
+
+    def visit_Call(self, node, *args):
+        if all(isinstance(arg, Num) for arg in args):
+            try:
+                function = self.mode.function(node.name, len(args))
+                if function.pure:
+                    return Num(Token(INTEGER, function.fn(*[arg.value for arg in args])))
+            except Exception:
+                # failing calls, wrong argument counts and unknown
+                # functions included, are reported by the compiled Program
+                pass
+        if all(arg is old for arg, old in zip(args, node.args)):
+            return node
+        return Call(node.token, list(args))
+
+    def visit_BinOp(self, node, left, right):
+        op = node.op.value
+
+        if isinstance(left, Num) and isinstance(right, Num):
+            try:
+                return Num(Token(INTEGER, self.ops[op](left.value, right.value)))
+            except (ArithmeticError, ValueError):
+                pass
+
+        if self.identities:
+            if op == '+' and is_int_const(right, 0):
+                return left
+            if op == '+' and is_int_const(left, 0):
+                return right
+            if op == '-' and is_int_const(right, 0):
+                return left
+            if op == '*' and is_int_const(right, 1):
+                return left
+            if op == '*' and is_int_const(left, 1):
+                return right
+
+        if self.reassociate and op in ('+', '*') and is_int_const(right) and isinstance(left, BinOp) \
+                and left.op.value == op:
+            # (A + c1) + c2 -> A + (c1 + c2), (c1 + A) + c2 -> A + (c1 + c2)
+            if is_int_const(left.right):
+                inner, const = left.left, left.right
+            elif is_int_const(left.left):
+                inner, const = left.right, left.left
+            else:
+                inner = None
+            if inner is not None:
+                folded = Num(Token(INTEGER, BINARY_OPS[op](const.value, right.value)))
+                return self.visit_BinOp(BinOp(inner, node.op, folded), inner, folded)
+
+        if left is node.left and right is node.right:
+            return node
+        return BinOp(left, node.op, right)
+
+    def optimize(self, tree):
+        return self.visit(tree)
+
+
+def is_int_const(node, value=None):
+    """True if node is an integer literal (equal to value, if given)."""
+    return (isinstance(node, Num) and type(node.value) is int
+            and (value is None or node.value == value))
+
+
+class Compiler(NodeVisitor):
+    """Flatten an AST into a postfix instruction list.
+
+    calc> 7 + 3 * (10 / (12 / (3 + 1) - 1))
+
+    LOAD_CONST 7, LOAD_CONST 3, LOAD_CONST 10, LOAD_CONST 12,
+    LOAD_CONST 3, LOAD_CONST 1, BINARY_OP +, BINARY_OP /, ...
+    """
+
+    def __init__(self, mode=FLOAT):
+        self.mode = mode
+        self.code = []
+
+    def visit_Num(self, node):
+        const = self.mode.const
+        self.code.append((LOAD_CONST, node.value if const is None else const(node.value)))
+
+    def visit_Var(self, node):
+        self.code.append((LOAD_NAME, node.name))
+
+    def visit_Group(self, node, inner):
+        # the inner expression has already been emitted
+        pass
+
+    def visit_UnaryOp(self, node, operand):
+        self.code.append((UNARY_OP, node.op.value))
+
+    def visit_Call(self, node, *args):
+        # the arguments have already been emitted, in order
+        self.code.append((CALL_FUNCTION, (node.name, len(args))))
+
+    def visit_BinOp(self, node, left, right):
+        # both operands have already been emitted, in order
+        self.code.append((BINARY_OP, node.op.value))
+
+    def compile(self, tree):
+        self.code = []
+        self.visit(tree)
+        return Program(self.code, self.mode)
+
+
+# a Program is lowered to a Python function after this many runs;
+# None keeps every Program on the instruction loop
+JIT_THRESHOLD = 64
+
+# infix spelling of the operators when a Program uses the plain BINARY_OPS;
+# ^ is always called, for the checks in _pow()
+_PY_OPERATORS = {'+': '+', '-': '-', '*': '*', '/': '/'}
+# identifier-safe spelling of the operators for generated names
+_OPERATOR_NAMES = {'+': 'add', '-': 'sub', '*': 'mul', '/': 'div', '^': 'pow'}
+_UNARY_NAMES = {'-': 'neg', '+': 'pos'}
+
+
+def _const_key(value):
+    """Key under which equal constants may share one slot or table entry.
+
+    Values that compare equal are not always interchangeable: 1 and 1.0,
+    0.0 and -0.0, Decimal('1.0') and Decimal('1.00') all differ.
+    """
+    if type(value) is float or isinstance(value, decimal.Decimal):
+        return type(value), repr(value)
+    return type(value), value
+
+
+def _literal(value):
+    """Python source for a constant, or None if it has to be bound as a name.
+
+    inf and nan are names that do not exist without builtins, -0.0 would
+    not be parenthesized below (-0.0 ** 2 is -0.0) and repr() refuses
+    ints beyond sys.get_int_max_str_digits().
+    """
+    if type(value) is int:
+        if value.bit_length() > 4096:
+            return None
+    elif type(value) is not float or not math.isfinite(value):
+        return None
+    elif not value and math.copysign(1.0, value) < 0:
+        return None
+    # parenthesized, as -2 ** 2 would be -(2 ** 2)
+    return repr(value) if value >= 0 else '({0!r})'.format(value)
+
+
+class Program(object):
+    """A compiled expression that can be run any number of times.
+
+    A Program starts out on the instruction loop. Once it has run
+    JIT_THRESHOLD times it is lowered to Python source, compiled with
+    compile() and from then on runs as a CPython function.
+    """
+
+    def __init__(self, code, mode=FLOAT):
+        self.code = code
+        self.mode = mode
+        self.names = frozenset(arg for opcode, arg in code if opcode == LOAD_NAME)
+        # resolve operators and functions once instead of on every run
+        self._ops = self.resolve(mode.ops)
+        self.runs = 0
+        # the lowered function, or False if the program cannot be lowered
+        self._native = None
+
+    def resolve(self, ops, vectorized=False):
+        """Return the instructions with operators replaced by ops[op].
+
+        Signs come from the mode's unary table and functions from
+        mode.function(), their vectorized versions if vectorized is true.
+        """
+        unary = self.mode.unary
+        instructions = []
+        for opcode, arg in self.code:
+            if opcode == BINARY_OP:
+                arg = ops[arg]
+            elif opcode == UNARY_OP:
+                arg = unary[arg]
+            elif opcode == CALL_FUNCTION:
+                function = self.mode.function(*arg)
+                arg = (function.vectorized if vectorized else function.fn, arg[1])
+            instructions.append((opcode, arg))
+        return instructions
+
+    def run(self, env=None, ops=None, vectorized=False):
+        """Execute the program.
+
+        env maps variable names to values, ops maps operator characters
+        to the functions that implement them (those of the Program's
+        numeric mode by default). vectorized=True calls the vectorized
+        versions of functions, for NumPy arrays in env.
+        """
+        stats = _stats
+        if stats is not None:
+            start = time.perf_counter()
+        if ops is not None or vectorized:
+            result = self.interpret(env, self.resolve(self.mode.ops if ops is None else ops, vectorized))
+        else:
+            native = self._native
+            if native is None:
+                self.runs += 1
+                if self.runs == JIT_THRESHOLD:
+                    native = self._native = self.lower() or False
+            if native:
+                try:
+                    result = native(env)
+                except (KeyError, TypeError):
+                    # let the instruction loop report the error properly
+                    result = self.interpret(env, self._ops)
+            else:
+                result = self.interpret(env, self._ops)
+        if stats is not None:
+            stats.record('eval', time.perf_counter() - start, self.operator_counts())
+        return result
+
+    def interpret(self, env, instructions):
+        """Run resolved instructions on a value stack."""
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        for opcode, arg in instructions:
+            if opcode == LOAD_CONST:
+                push(arg)
+            elif opcode == LOAD_NAME:
+                try:
+                    push(env[arg])
+                except (KeyError, TypeError):
+                    raise Exception('Undefined variable {0}'.format(arg))
+            elif opcode == BINARY_OP:
+                right = pop()
+                stack[-1] = arg(stack[-1], right)
+            elif opcode == UNARY_OP:
+                stack[-1] = arg(stack[-1])
+            else:
+                function, count = arg
+                start = len(stack) - count
+                args = stack[start:]
+                del stack[start:]
+                push(function(*args))
+        return stack[-1]
+
+    def python_source(self):
+        """Return (source, namespace) of an equivalent Python lambda.
+
+        calc> 7 + x * 2   ->   lambda env: (7 + (env['x'] * 2))
+
+        Numbers without a Python literal (see _literal), operators of other
+        numeric modes and functions are bound as names in namespace.
+        """
+        namespace = {'__builtins__': {}}
+        infix = self.mode.ops is BINARY_OPS
+        stack = []
+        for opcode, arg in self.code:
+            if opcode == LOAD_CONST:
+                literal = _literal(arg)
+                if literal is None:
+                    literal = '_c{0}'.format(len(namespace))
+                    namespace[literal] = arg
+                stack.append(literal)
+            elif opcode == LOAD_NAME:
+                stack.append('env[{0!r}]'.format(arg))
+            elif opcode == UNARY_OP:
+                operand = stack.pop()
+                if self.mode.unary is UNARY_OPS:
+                    stack.append('({0}{1})'.format(arg, operand))
+                else:
+                    name = '_u{0}'.format(len(namespace))
+                    namespace[name] = self.mode.unary[arg]
+                    stack.append('{0}({1})'.format(name, operand))
+            elif opcode == CALL_FUNCTION:
+                function_name, count = arg
+                start = len(stack) - count
+                args = stack[start:]
+                del stack[start:]
+                name = '_g{0}'.format(len(namespace))
+                namespace[name] = self.mode.function(function_name, count).fn
+                stack.append('{0}({1})'.format(name, ', '.join(args)))
+            else:
+                right = stack.pop()
+                left = stack.pop()
+                if infix and arg in _PY_OPERATORS:
+                    stack.append('({0} {1} {2})'.format(left, _PY_OPERATORS[arg], right))
+                else:
+                    name = '_f{0}'.format(len(namespace))
+                    namespace[name] = self.mode.ops[arg]
+                    stack.append('{0}({1}, {2})'.format(name, left, right))
+        return 'lambda env: ' + stack[-1], namespace
+
+    def lower(self):
+        """Compile the program to a Python function, or None if it cannot be."""
+        source, namespace = self.python_source()
+        try:
+            return eval(compile(source, '<calc6>', 'eval'), namespace)
+        except (SyntaxError, RecursionError, MemoryError):
+            # e.g. deeper nesting than the CPython parser allows
+            return None
+
+    def operator_counts(self):
+        """How many times each operator runs per evaluation.
+
+        Signs are counted as 'unary-' and 'unary+', function calls as
+        'name()'.
+        """
+        counts = self.__dict__.get('_operator_counts')
+        if counts is None:
+            counts = self._operator_counts = Counter()
+            for opcode, arg in self.code:
+                if opcode == BINARY_OP:
+                    counts[arg] += 1
+                elif opcode == UNARY_OP:
+                    counts['unary' + arg] += 1
+                elif opcode == CALL_FUNCTION:
+                    counts[arg[0] + '()'] += 1
+        return counts
+
+    def __str__(self):
+        return '\n'.join('{0} {1}'.format(opcode, arg) for opcode, arg in self.code)
+
+    __repr__ = __str__
+
+
+def compile_expr(text, optimize=True, parser=PrecedenceParser, mode=FLOAT):
+    """Lex, parse and compile text into a reusable Program.
+
+    parser is PrecedenceParser or the recursive descent Parser; mode is
+    FLOAT, INT, FRACTION, EXACT or a DecimalMode.
+    """
+    stats = _stats
+    if stats is None:
+        return compile_tokens(RegexLexer(text), optimize, parser, mode)
+    start = time.perf_counter()
+    lexer = RegexLexer(text)
+    stats.record('lex', time.perf_counter() - start)
+    stats.record_tokens(lexer.stream)
+    return compile_tokens(lexer, optimize, parser, mode)
+
+
+def compile_tokens(lexer, optimize=True, parser=PrecedenceParser, mode=FLOAT):
+    """Parse and compile the remaining tokens of lexer."""
+    stats = _stats
+    if stats is None:
+        tree = parser(lexer).parse()
+        mode = mode.bind(tree)
+        if optimize:
+            tree = Optimizer(mode).optimize(tree)
+        return Compiler(mode).compile(tree)
+
+    clock = time.perf_counter
+    start = clock()
+    tree = parser(lexer).parse()
+    mode = mode.bind(tree)
+    stats.record('parse', clock() - start)
+    if optimize:
+        start = clock()
+        tree = Optimizer(mode).optimize(tree)
+        stats.record('optimize', clock() - start)
+    start = clock()
+    program = Compiler(mode).compile(tree)
+    stats.record('compile', clock() - start)
+    return program
+
+
+class Stats(object):
+    """Opt-in timings and counters for the compile and evaluation phases.
+
+    >>> stats = enable_stats(Stats(callback=print))
+    >>> compile_expr('2 * (x + 1)').run({'x': 3})
+    lex 1.2e-05
+    parse 9.1e-06
+    ...
+    >>> stats.snapshot()['operators']
+    {'+': 1, '*': 1}
+
+    While no Stats is enabled the only cost is one global lookup per
+    compile and per run.
+    """
+
+    PHASES = ('lex', 'parse', 'optimize', 'compile', 'eval')
+
+    def __init__(self, callback=None):
+        # callback(phase, seconds) is called after every recorded phase
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.tokens = 0
+        self.max_depth = 0
+        self.operators = Counter()
+
+    def record(self, phase, seconds, operators=None):
+        with self._lock:
+            self.times[phase] += seconds
+            self.calls[phase] += 1
+            if operators:
+                self.operators.update(operators)
+        if self.callback is not None:
+            self.callback(phase, seconds)
+
+    def record_tokens(self, stream):
+        """Count the tokens of a TokenStream and its parenthesis depth."""
+        depth = deepest = 0
+        open_code, close_code = TOKEN_CODES[LPAREN], TOKEN_CODES[RPAREN]
+        for code in stream.kinds:
+            if code == open_code:
+                depth += 1
+                if depth > deepest:
+                    deepest = depth
+            elif code == close_code:
+                depth -= 1
+        with self._lock:
+            # the EOF token does not count
+            self.tokens += len(stream) - 1
+            self.max_depth = max(self.max_depth, deepest)
+
+    def snapshot(self):
+        """Return a plain dict of everything collected so far."""
+        with self._lock:
+            return {
+                'times': dict(self.times),
+                'calls': dict(self.calls),
+                'tokens': self.tokens,
+                'max_depth': self.max_depth,
+                'operators': dict(self.operators),
+            }
+
+
+_stats = None
+
+
+def enable_stats(stats=None):
+    """Start collecting into stats (a new Stats by default) and return it."""
+    global _stats
+    _stats = Stats() if stats is None else stats
+    return _stats
+
+
+def disable_stats():
+    global _stats
+    _stats = None
+
+
+def compile_statement(text):
+    """Compile a statement, returning (name, Program).
+
+    statement : ID ASSIGN expr | expr
+
+    name is None for a bare expression.
+    """
+    lexer = RegexLexer(text)
+    stream = lexer.stream
+    name = None
+    if len(stream) > 2 and stream.type(0) == ID and stream.type(1) == ASSIGN:
+        name = stream.values[0]
+        lexer.index = 2
+    return name, compile_tokens(lexer)
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+# whitespace next to an operator or parenthesis never changes the meaning
+_SPACE_AROUND_OP = re.compile(r'\s*([^\w\s])\s*')
+_SPACE_RUN = re.compile(r'\s+')
+
+
+def normalize(text):
+    """Return the cache key for text.
+
+    Whitespace is dropped around operators and parentheses only: a run of
+    spaces between two digits is kept (as one space) so that '1 2', which
+    is a syntax error, does not share a key with '12'.
+    """
+    return _SPACE_RUN.sub(' ', _SPACE_AROUND_OP.sub(r'\1', text)).strip()
+
+
+class ExprCache(object):
+    """Least-recently-used cache of compiled Programs.
+
+    Keyed on normalized text and numeric mode. The normalized form of
+    each raw text is remembered too, so a hit on text seen before is a
+    dict lookup instead of a normalize() over the whole text.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._programs = OrderedDict()
+        # raw text -> normalize(text); emptied when it reaches maxsize
+        self._normalized = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def _normalize(self, text):
+        normalized = normalize(text)
+        with self._lock:
+            if len(self._normalized) >= self.maxsize:
+                self._normalized.clear()
+            self._normalized[text] = normalized
+        return normalized
+
+    def get(self, text, mode=FLOAT):
+        normalized = self._normalized.get(text)
+        if normalized is None:
+            normalized = self._normalize(text)
+        key = (normalized, mode)
+        with self._lock:
+            program = self._programs.get(key)
+            if program is not None:
+                self._programs.move_to_end(key)
+                self.hits += 1
+                return program
+            self.misses += 1
+        # compile outside the lock, a concurrent miss on the same key only
+        # costs a duplicate compile
+        program = compile_expr(key[0], mode=mode)
+        with self._lock:
+            self._programs[key] = program
+            if len(self._programs) > self.maxsize:
+                self._programs.popitem(last=False)
+                self.evictions += 1
+        return program
+
+    def clear(self):
+        with self._lock:
+            self._programs.clear()
+            self._normalized.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.maxsize, len(self._programs))
+
+    def __len__(self):
+        return len(self._programs)
+
+
+# process-wide cache used by compile_cached() and main()
+expr_cache = ExprCache()
+
+
+def compile_cached(text, mode=FLOAT):
+    """Return the compiled Program for text, reusing earlier compiles."""
+    return expr_cache.get(text, mode)
+
+
+# Binary format of compiled Programs, all numbers little-endian:
+#
+#   program : mode  u32 instruction count  constant*  name*  instruction*
+#   mode    : u8 tag, for decimal followed by the context: u32 prec,
+#             i64 Emin, i64 Emax, u8 capitals, u8 clamp, u16 trap bits
+#             (see _DECIMAL_SIGNALS) and the rounding string
+#   constant: u8 tag ('i', 'f', 'q' or 'd') and the value
+#   instr   : u8 opcode, u32 argument (constant, name or operator index;
+#             for a call the name index, plus the argument count << 24)
+#
+# Strings (UTF-8) and ints (two's complement) are a u32 byte length and
+# the bytes.
+#
+# A library is a header, the programs back to back and an index of
+# (name, offset, length) at the end:
+#
+#   header  : b'CALC6LIB' u16 version u32 count u64 index offset
+
+LIBRARY_MAGIC = b'CALC6LIB'
+LIBRARY_VERSION = 1
+_LENGTH = struct.Struct('<I')
+_HEADER = struct.Struct('<8sHIQ')
+_INSTRUCTION = struct.Struct('<BI')
+_OPCODES = (LOAD_CONST, LOAD_NAME, BINARY_OP, UNARY_OP, CALL_FUNCTION)
+_OPCODE_INDEX = dict((opcode, index) for index, opcode in enumerate(_OPCODES))
+_CALL_CODE = _OPCODE_INDEX[CALL_FUNCTION]
+_MAX_CALL_ARGS = 0xff
+_OPERATORS = ('+', '-', '*', '/', '^')
+_OPERATOR_INDEX = dict((op, index) for index, op in enumerate(_OPERATORS))
+_MODES = (FLOAT, INT, FRACTION)
+_MODE_INDEX = dict((mode, index) for index, mode in enumerate(_MODES))
+_DECIMAL_TAG = len(_MODES)
+_DECIMAL_CONTEXT = struct.Struct('<IqqBBH')
+_DECIMAL_SIGNALS = (decimal.Clamped, decimal.DivisionByZero, decimal.Inexact, decimal.Overflow,
+                    decimal.Rounded, decimal.Underflow, decimal.InvalidOperation,
+                    decimal.Subnormal, decimal.FloatOperation)
+
+
+def _pack_str(text):
+    data = text.encode('utf-8')
+    return _LENGTH.pack(len(data)) + data
+
+
+def _unpack_str(data, pos):
+    size, = _LENGTH.unpack_from(data, pos)
+    pos += _LENGTH.size
+    return bytes(data[pos:pos + size]).decode('utf-8'), pos + size
+
+
+def _pack_int(value):
+    data = value.to_bytes(value.bit_length() // 8 + 1, 'little', signed=True)
+    return _LENGTH.pack(len(data)) + data
+
+
+def _unpack_int(data, pos):
+    size, = _LENGTH.unpack_from(data, pos)
+    pos += _LENGTH.size
+    return int.from_bytes(data[pos:pos + size], 'little', signed=True), pos + size
+
+
+def _pack_const(value):
+    if type(value) is int:
+        return b'i' + _pack_int(value)
+    if type(value) is float:
+        return b'f' + struct.pack('<d', value)
+    if isinstance(value, Fraction):
+        return b'q' + _pack_int(value.numerator) + _pack_int(value.denominator)
+    if isinstance(value, decimal.Decimal):
+        return b'd' + _pack_str(str(value))
+    raise Exception('Cannot serialize constant {0!r}'.format(value))
+
+
+def _unpack_const(data, pos):
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == b'i':
+        return _unpack_int(data, pos)
+    if tag == b'f':
+        return struct.unpack_from('<d', data, pos)[0], pos + 8
+    if tag == b'q':
+        numerator, pos = _unpack_int(data, pos)
+        denominator, pos = _unpack_int(data, pos)
+        return Fraction(numerator, denominator), pos
+    if tag == b'd':
+        text, pos = _unpack_str(data, pos)
+        return decimal.Decimal(text), pos
+    raise Exception('Unknown constant tag {0!r}'.format(tag))
+
+
+def dumps(program):
+    """Serialize a compiled Program to bytes."""
+    mode = program.mode
+    if isinstance(mode, DecimalMode):
+        context = mode.context
+        traps = sum(1 << bit for bit, signal in enumerate(_DECIMAL_SIGNALS) if context.traps[signal])
+        parts = [struct.pack('<B', _DECIMAL_TAG),
+                 _DECIMAL_CONTEXT.pack(context.prec, context.Emin, context.Emax,
+                                       context.capitals, context.clamp, traps),
+                 _pack_str(context.rounding)]
+    elif mode in _MODE_INDEX:
+        parts = [struct.pack('<B', _MODE_INDEX[mode])]
+    else:
+        raise Exception('Cannot serialize numeric mode {0!r}'.format(mode))
+
+    consts, names, instructions = [], [], []
+    const_index, name_index = {}, {}
+    for opcode, arg in program.code:
+        if opcode == LOAD_CONST:
+            key = _const_key(arg)
+            if key not in const_index:
+                const_index[key] = len(consts)
+                consts.append(_pack_const(arg))
+            index = const_index[key]
+        elif opcode == LOAD_NAME or opcode == CALL_FUNCTION:
+            name, count = (arg, 0) if opcode == LOAD_NAME else arg
+            if count > _MAX_CALL_ARGS:
+                raise Exception('Cannot serialize a call with {0} arguments'.format(count))
+            if name not in name_index:
+                name_index[name] = len(names)
+                names.append(_pack_str(name))
+            index = name_index[name] | count << 24
+        else:
+            index = _OPERATOR_INDEX[arg]
+        instructions.append(_INSTRUCTION.pack(_OPCODE_INDEX[opcode], index))
+
+    parts.append(struct.pack('<III', len(instructions), len(consts), len(names)))
+    parts.extend(consts)
+    parts.extend(names)
+    parts.extend(instructions)
+    return b''.join(parts)
+
+
+def loads(data, _decimal_modes=None):
+    """Rebuild a Program from dumps() output (bytes or a memoryview)."""
+    tag = data[0]
+    pos = 1
+    if tag == _DECIMAL_TAG:
+        settings = _DECIMAL_CONTEXT.unpack_from(data, pos)
+        rounding, pos = _unpack_str(data, pos + _DECIMAL_CONTEXT.size)
+        # programs loaded together share one mode per context
+        modes = {} if _decimal_modes is None else _decimal_modes
+        key = settings + (rounding,)
+        if key not in modes:
+            prec, emin, emax, capitals, clamp, traps = settings
+            modes[key] = DecimalMode(prec=prec, rounding=rounding, Emin=emin, Emax=emax,
+                                     capitals=capitals, clamp=clamp,
+                                     traps=[signal for bit, signal in enumerate(_DECIMAL_SIGNALS)
+                                            if traps >> bit & 1])
+        mode = modes[key]
+    else:
+        mode = _MODES[tag]
+
+    count, const_count, name_count = struct.unpack_from('<III', data, pos)
+    pos += 12
+    consts = []
+    for _ in range(const_count):
+        value, pos = _unpack_const(data, pos)
+        consts.append(value)
+    names = []
+    for _ in range(name_count):
+        name, pos = _unpack_str(data, pos)
+        names.append(sys.intern(name))
+    tables = (consts, names, _OPERATORS, _OPERATORS)
+    end = pos + count * _INSTRUCTION.size
+    code = [(_OPCODES[opcode], tables[opcode][index]) if opcode != _CALL_CODE
+            else (CALL_FUNCTION, (names[index & 0xffffff], index >> 24))
+            for opcode, index in _INSTRUCTION.iter_unpack(data[pos:end])]
+    return Program(code, mode)
+
+
+def save_library(path, programs):
+    """Write {name: Program} (or (name, Program) pairs) to a library file."""
+    if hasattr(programs, 'items'):
+        programs = programs.items()
+    index = []
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(LIBRARY_MAGIC, LIBRARY_VERSION, 0, 0))
+        offset = _HEADER.size
+        for name, program in programs:
+            data = dumps(program)
+            f.write(data)
+            index.append(_pack_str(name) + struct.pack('<QI', offset, len(data)))
+            offset += len(data)
+        f.write(b''.join(index))
+        f.seek(0)
+        f.write(_HEADER.pack(LIBRARY_MAGIC, LIBRARY_VERSION, len(index), offset))
+
+
+class Library(object):
+    """Read-only, memory-mapped library of compiled Programs.
+
+    Opening a library only reads its index; each Program is decoded from
+    the mapped file the first time it is asked for, with no lexing or
+    parsing.
+
+    >>> save_library('rules.lib', {'tax': compile_expr('price * 21 / 100')})
+    >>> Library('rules.lib')['tax'].run({'price': 200})
+    42.0
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._data = memoryview(self._map)
+        magic, version, count, pos = _HEADER.unpack_from(self._data, 0)
+        if magic != LIBRARY_MAGIC or version != LIBRARY_VERSION:
+            self.close()
+            raise Exception('{0} is not a calc6 library'.format(path))
+        self._index = {}
+        for _ in range(count):
+            name, pos = _unpack_str(self._data, pos)
+            self._index[name] = struct.unpack_from('<QI', self._data, pos)
+            pos += 12
+        self._programs = {}
+        self._decimal_modes = {}
+
+    def __getitem__(self, name):
+        program = self._programs.get(name)
+        if program is None:
+            offset, size = self._index[name]
+            program = loads(self._data[offset:offset + size], self._decimal_modes)
+            self._programs[name] = program
+        return program
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        self._programs.clear()
+        self._data.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_UFUNCS = None
+
+
+def evaluate_columns(text, columns):
+    """Evaluate one expression column-wise over equal-length NumPy arrays.
+
+    >>> evaluate_columns('price * (qty - 1)', {'price': [2, 3], 'qty': [5, 2]})
+    array([8, 3])
+
+    The expression is compiled once and every operator runs as a single
+    ufunc over whole columns, so there is no per-row interpreter work.
+    Functions run in their vectorized versions, e.g. np.sqrt for sqrt().
+    """
+    global _UFUNCS
+    import numpy as np
+    if _UFUNCS is None:
+        _UFUNCS = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.true_divide,
+                   '^': np.power}
+
+    program = compile_cached(text)
+    arrays = {}
+    size = None
+    for name in program.names:
+        if name not in columns:
+            raise Exception('Undefined variable {0}'.format(name))
+        array = np.asarray(columns[name])
+        if array.ndim != 1:
+            raise Exception('Column {0} is not one-dimensional'.format(name))
+        if size is None:
+            size = len(array)
+        elif len(array) != size:
+            raise Exception('Column {0} has length {1}, expected {2}'.format(name, len(array), size))
+        arrays[name] = array
+    if size is None:
+        # no variables: broadcast the constant to the length of the input
+        size = len(next(iter(columns.values()))) if columns else 1
+    result = program.run(arrays, _UFUNCS, vectorized=True)
+    if np.ndim(result) == 0:
+        return np.broadcast_to(result, (size,))
+    if any(result is array for array in arrays.values()):
+        # a bare variable such as (x); never hand back the caller's column
+        result = result.copy()
+    return result
+
+
+class Sheet(object):
+    """Named formulas that are recomputed incrementally.
+
+    calc> a = 2
+    calc> b = a * 3
+    calc> c = 10
+    calc> a = 5         # recomputes a and b, c is left alone
+    calc> b
+    15
+
+    A formula is re-evaluated only when a name it reads changes. A
+    formula whose inputs are missing or fail keeps the error instead of a
+    value, and raises it when read.
+    """
+
+    def __init__(self):
+        self.formulas = {}
+        self.values = {}
+        self.errors = {}
+        # name -> names of the formulas that read it
+        self.dependents = defaultdict(set)
+
+    def execute(self, text):
+        """Run 'name = expr' or evaluate a bare expression against the sheet.
+
+        Returns the value, or raises the error, of the expression or of
+        the newly assigned name.
+        """
+        name, program = compile_statement(text)
+        if name is None:
+            return program.run(self.values)
+        self.assign(name, program)
+        return self[name]
+
+    def set(self, name, text):
+        self.assign(name, compile_cached(text))
+
+    def assign(self, name, program):
+        if self._reaches(program.names, name):
+            raise Exception('Circular reference to {0}'.format(name))
+        old = self.formulas.get(name)
+        if old is not None:
+            for input in old.names:
+                self.dependents[input].discard(name)
+        self.formulas[name] = program
+        for input in program.names:
+            self.dependents[input].add(name)
+        self.recompute(name)
+
+    def remove(self, name):
+        program = self.formulas.pop(name)
+        for input in program.names:
+            self.dependents[input].discard(name)
+        self.values.pop(name, None)
+        self.errors.pop(name, None)
+        self.recompute(name, include_self=False)
+
+    def _reaches(self, names, target):
+        """True if target is among names or anything they are computed from."""
+        seen = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name == target:
+                return True
+            if name not in seen:
+                seen.add(name)
+                formula = self.formulas.get(name)
+                if formula is not None:
+                    pending.extend(formula.names)
+        return False
+
+    def recompute(self, name, include_self=True):
+        """Re-evaluate name and everything that depends on it, inputs first."""
+        affected = set()
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            if current not in affected:
+                affected.add(current)
+                pending.extend(self.dependents.get(current, ()))
+        if not include_self:
+            affected.discard(name)
+
+        # Kahn's algorithm over the affected part of the graph
+        waiting = dict((n, len(self.formulas[n].names & affected)) for n in affected)
+        ready = [n for n, count in waiting.items() if count == 0]
+        while ready:
+            current = ready.pop()
+            self._evaluate(current)
+            for dependent in self.dependents.get(current, ()):
+                if dependent in waiting:
+                    waiting[dependent] -= 1
+                    if waiting[dependent] == 0:
+                        ready.append(dependent)
+
+    def _evaluate(self, name):
+        try:
+            self.values[name] = self.formulas[name].run(self.values)
+            self.errors.pop(name, None)
+        except Exception as e:
+            self.values.pop(name, None)
+            self.errors[name] = e
+
+    def __getitem__(self, name):
+        if name in self.errors:
+            raise self.errors[name]
+        try:
+            return self.values[name]
+        except KeyError:
+            raise Exception('Undefined variable {0}'.format(name))
+
+    def __contains__(self, name):
+        return name in self.formulas
+
+
+class _TokenList(object):
+    """Feed a ready list of tokens to a parser."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.tokens.append(_SHARED_TOKENS[None])
+        self.index = 0
+
+    def get_next_token(self):
+        token = self.tokens[self.index]
+        if self.index < len(self.tokens) - 1:
+            self.index += 1
+        return token
+
+
+class Document(object):
+    """An expression that is re-lexed and re-parsed incrementally.
+
+    >>> doc = Document('1 + (2 * (3 + x))')
+    >>> doc.edit(14, 1, '4')           # now '1 + (2 * (3 + 4))'
+    >>> doc.program().run()
+    15
+
+    An edit only re-lexes the tokens it touches, and only re-parses the
+    innermost parenthesized group around them. Untouched groups inside
+    that group are reused as they are. The whole text is parsed again
+    only after an edit that unbalances parentheses, or on the first edit
+    after a syntax error. At the top level, which has no group around it,
+    only the term between the nearest binary + or - on either side is
+    re-parsed, unless the edit adds or removes such an operator.
+
+    Token offsets after an edit are not rewritten right away: one pending
+    shift covers everything behind the last edit and is settled only up
+    to the next edit, so typing in one place stays cheap in long texts.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        # one entry per token: type, value, offsets in text and, for
+        # parentheses, the Group they open or close
+        self.kinds, self.values, self._starts, self._ends = lex_spans(text)
+        self.groups = [None] * len(self.kinds)
+        # for every binary + or - at the top level, the BinOp it makes:
+        # the terms between them can be re-parsed one at a time
+        self.joins = [None] * len(self.kinds)
+        # offsets of tokens from _shift_from on are off by _shift
+        self._shift_from = len(self.kinds)
+        self._shift = 0
+        self.root = Group()
+        self.error = None
+        self._parse_all()
+
+    def span(self, index):
+        """Return the (start, end) offsets of token index in text."""
+        shift = self._shift if index >= self._shift_from else 0
+        return self._starts[index] + shift, self._ends[index] + shift
+
+    def _bisect(self, positions, offset, bisect):
+        split = self._shift_from
+        index = bisect(positions, offset, 0, split)
+        if index < split:
+            return index
+        return bisect(positions, offset - self._shift, split, len(positions))
+
+    def _move_shift(self, index):
+        """Settle offsets so that the pending shift starts at index."""
+        split, shift = self._shift_from, self._shift
+        if shift:
+            starts, ends = self._starts, self._ends
+            if split < index:
+                starts[split:index] = [start + shift for start in starts[split:index]]
+                ends[split:index] = [end + shift for end in ends[split:index]]
+            elif index < split:
+                starts[index:split] = [start - shift for start in starts[index:split]]
+                ends[index:split] = [end - shift for end in ends[index:split]]
+        self._shift_from = index
+
+    def edit(self, offset, deleted, inserted):
+        """Replace deleted characters at offset with the inserted text."""
+        text = self.text
+        end = offset + deleted
+        if offset < 0 or end > len(text):
+            raise Exception('Edit {0}:{1} outside of the text'.format(offset, end))
+        self.text = text[:offset] + inserted + text[end:]
+        delta = len(inserted) - deleted
+
+        # tokens overlapping the edit are lexed again, and so are numbers
+        # and names touching it or glued to those, as in '1x': '12' + '3'
+        # becomes one token. Operators and parentheses next to the edit
+        # cannot merge and are left alone.
+        first = self._bisect(self._ends, offset, bisect_right)
+        last = self._bisect(self._starts, end, bisect_left)
+        lo, hi = offset, end
+        if first < last:
+            lo = min(lo, self.span(first)[0])
+            hi = max(hi, self.span(last - 1)[1])
+        while first > 0 and self.kinds[first - 1] in (INTEGER, ID) \
+                and self.span(first - 1)[1] == lo:
+            first -= 1
+            lo = self.span(first)[0]
+        while last < len(self.kinds) and self.kinds[last] in (INTEGER, ID) \
+                and self.span(last)[0] == hi:
+            hi = self.span(last)[1]
+            last += 1
+        kinds, values, starts, ends = lex_spans(self.text[lo:hi + delta], lo)
+        # a '(' right behind the edited tokens opens a call after a name
+        # and a group otherwise
+        before_paren = last < len(self.kinds) and self.kinds[last] == LPAREN
+        was_call = before_paren and last > 0 and self.kinds[last - 1] == ID
+
+        # everything behind the edited tokens moves by delta
+        self._move_shift(last)
+        old_kinds = self.kinds[first:last]
+        self.kinds[first:last] = kinds
+        self.values[first:last] = values
+        self.groups[first:last] = [None] * len(kinds)
+        self.joins[first:last] = [None] * len(kinds)
+        self._starts[first:last] = starts
+        self._ends[first:last] = ends
+        stop = first + len(kinds)
+        self._shift_from = stop
+        self._shift += delta
+        is_call = before_paren and stop > 0 and self.kinds[stop - 1] == ID
+
+        if self.error is not None or was_call != is_call \
+                or not _balanced(old_kinds) or not _balanced(kinds):
+            self._parse_all()
+        else:
+            self._reparse(first, stop, len(kinds) - len(old_kinds))
+
+    def _parse_all(self):
+        self.groups = [None] * len(self.kinds)
+        self._build_top()
+
+    def _build_top(self):
+        """Parse the top level, reusing intact groups, and find its joins."""
+        kinds, groups = self.kinds, self.groups
+        self._build(0, len(kinds), self.root)
+        self.joins = joins = [None] * len(kinds)
+        if self.error is not None:
+            return
+        operators = []
+        depth = 0
+        index = 0
+        while index < len(kinds):
+            kind = kinds[index]
+            if kind == LPAREN and groups[index] is not None:
+                index += groups[index].size
+                continue
+            if kind == LPAREN:
+                depth += 1
+            elif kind == RPAREN:
+                depth -= 1
+            elif kind == PR2 and not depth and index and kinds[index - 1] in _OPERAND_END:
+                operators.append(index)
+            index += 1
+        # ((a + b) - c) + d: the last operator joins the root, the first
+        # one the first two terms
+        node = self.root.inner
+        for index in reversed(operators):
+            joins[index] = node
+            node = node.left
+
+    def _reparse_term(self, lo, hi):
+        """Re-parse the top-level terms around tokens lo..hi in place.
+
+        Only the tokens between the nearest joins on either side are
+        parsed again; the edit may add or remove + and - in there, which
+        splices terms into or out of the chain. Returns False if the
+        join behind them would no longer be binary, for the caller to
+        re-parse the whole top level.
+        """
+        kinds, groups, joins = self.kinds, self.groups, self.joins
+        left = lo - 1
+        while left >= 0 and joins[left] is None:
+            if kinds[left] == RPAREN and groups[left] is not None:
+                left -= groups[left].size
+            else:
+                left -= 1
+        right = hi
+        while right < len(kinds) and joins[right] is None:
+            if kinds[right] == LPAREN and groups[right] is not None:
+                right += groups[right].size
+            else:
+                right += 1
+        if left < 0 and right == len(kinds):
+            return False
+        # a join stays binary only after an operand
+        if right < len(kinds) and (right - left < 2 or kinds[right - 1] not in _OPERAND_END):
+            return False
+        # binary + and - between the joins split the tokens into terms
+        operators = []
+        depth = 0
+        index = left + 1
+        while index < right:
+            kind = kinds[index]
+            if kind == LPAREN and groups[index] is not None:
+                index += groups[index].size
+                continue
+            if kind == LPAREN:
+                depth += 1
+            elif kind == RPAREN:
+                depth -= 1
+            elif kind == PR2 and not depth and index > left + 1 and kinds[index - 1] in _OPERAND_END:
+                operators.append(index)
+            index += 1
+        terms = []
+        start = left + 1
+        for end in operators + [right]:
+            tree = self._parse(start, end, self.root)
+            if tree is None:
+                return True
+            terms.append(tree)
+            start = end + 1
+        if left >= 0:
+            joins[left].right = terms[0]
+            node = joins[left]
+        else:
+            node = terms[0]
+        for index, term in zip(operators, terms[1:]):
+            node = joins[index] = BinOp(node, _SHARED_TOKENS[self.values[index]], term)
+        if right < len(kinds):
+            joins[right].left = node
+        else:
+            self.root.inner = node
+        return True
+
+    def _reparse(self, lo, hi, token_delta):
+        kinds, groups, joins = self.kinds, self.groups, self.joins
+        # walk outwards from the edited tokens, jumping over sibling groups,
+        # to the parentheses of the innermost group around them; those of
+        # calls have no group and are walked through. Joins only exist at
+        # the top level, so reaching one means there is no such group.
+        open_index = lo - 1
+        while open_index >= 0 and joins[open_index] is None \
+                and (kinds[open_index] != LPAREN or groups[open_index] is None):
+            if kinds[open_index] == RPAREN and groups[open_index] is not None:
+                open_index -= groups[open_index].size
+            else:
+                open_index -= 1
+        if open_index < 0 or joins[open_index] is not None:
+            if not self._reparse_term(lo, hi):
+                self._build_top()
+            return
+        close_index = hi
+        while close_index < len(kinds) and (kinds[close_index] != RPAREN or groups[close_index] is None):
+            if kinds[close_index] == LPAREN and groups[close_index] is not None:
+                close_index += groups[close_index].size
+            else:
+                close_index += 1
+
+        group = groups[open_index]
+        self._build(open_index + 1, close_index, group)
+        group.size = close_index - open_index + 1
+        parent = group.parent
+        while parent is not self.root:
+            parent.size += token_delta
+            parent = parent.parent
+
+    def _build(self, lo, hi, owner):
+        """Parse tokens lo..hi into owner.inner, reusing intact groups."""
+        tree = self._parse(lo, hi, owner)
+        if tree is not None:
+            owner.inner = tree
+
+    def _parse(self, lo, hi, owner):
+        """Return the tree of tokens lo..hi, None after a syntax error.
+
+        Groups at the outer level get owner as their parent. The
+        parentheses of a call are not a group: the call is parsed with
+        the tokens around it.
+        """
+        kinds, values, groups = self.kinds, self.values, self.groups
+        try:
+            # one (items, group, open index, is call) per parenthesis
+            # level; a call level shares the items and group of the
+            # level it is in
+            levels = [([], owner, None, False)]
+            index = lo
+            while index < hi:
+                kind = kinds[index]
+                items = levels[-1][0]
+                if kind == LPAREN:
+                    if index > lo and kinds[index - 1] == ID:
+                        items.append(_SHARED_TOKENS[LPAREN])
+                        levels.append((items, levels[-1][1], index, True))
+                        index += 1
+                        continue
+                    group = groups[index]
+                    if group is not None:
+                        group.parent = levels[-1][1]
+                        items.append(Token(GROUP, group))
+                        index += group.size
+                        continue
+                    levels.append(([], Group(), index, False))
+                elif kind == RPAREN:
+                    if len(levels) == 1:
+                        raise Exception('Invalid syntax. {0}'.format(_SHARED_TOKENS[RPAREN]))
+                    items, group, open_index, call = levels.pop()
+                    if call:
+                        items.append(_SHARED_TOKENS[RPAREN])
+                        groups[open_index] = groups[index] = None
+                        index += 1
+                        continue
+                    group.inner = PrecedenceParser(_TokenList(items)).parse()
+                    group.parent = levels[-1][1]
+                    group.size = index - open_index + 1
+                    groups[open_index] = groups[index] = group
+                    levels[-1][0].append(Token(GROUP, group))
+                elif kind is None:
+                    raise Exception('Invalid character.')
+                else:
+                    items.append(Token(kind, values[index]))
+                index += 1
+            if len(levels) > 1:
+                raise Exception('Invalid syntax. {0}'.format(_SHARED_TOKENS[None]))
+            tree = PrecedenceParser(_TokenList(levels[0][0])).parse()
+            self.error = None
+            return tree
+        except Exception as e:
+            self.error = e
+            return None
+
+    @property
+    def tree(self):
+        if self.error is not None:
+            raise self.error
+        return self.root.inner
+
+    def program(self, mode=FLOAT):
+        tree = self.tree
+        mode = mode.bind(tree)
+        return Compiler(mode).compile(Optimizer(mode).optimize(tree))
+
+
+def _balanced(kinds):
+    depth = 0
+    for kind in kinds:
+        if kind == LPAREN:
+            depth += 1
+        elif kind == RPAREN:
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+Diagnostic = namedtuple('Diagnostic', ['line', 'position', 'found', 'expected', 'message'])
+
+_OPERAND = (INTEGER, ID, LPAREN, PR2)
+# a + or - after these is binary
+_OPERAND_END = (INTEGER, ID, RPAREN)
+_OPERATOR = (PR1, PR2, PR3, RPAREN)
+
+
+def _describe(kind, value):
+    if kind == EOF:
+        return 'end of input'
+    return str(value)
+
+
+def validate(text, line=None, statement=False):
+    """Return a Diagnostic for every syntax error in text.
+
+    Unlike the parsers, which stop at the first problem, this keeps
+    going: a stray token is skipped, a missing operator is assumed,
+    and every unbalanced parenthesis is reported. position is the
+    offset of the offending token in text, expected lists the token
+    types that would have been accepted there. With statement=True a
+    leading 'name =' is allowed.
+    """
+    kinds, values, starts, ends = lex_spans(text)
+    kinds.append(EOF)
+    values.append(None)
+    starts.append(len(text))
+    diagnostics = []
+
+    def report(index, expected, message):
+        diagnostics.append(Diagnostic(line, starts[index], _describe(kinds[index], values[index]),
+                                      expected, message))
+
+    def expected_operator():
+        # a ',' is only expected between the arguments of a call
+        if opened and opened[-1][1]:
+            return _OPERATOR + (COMMA, EOF)
+        return _OPERATOR + (EOF,)
+
+    index = 0
+    if statement and len(kinds) > 2 and kinds[0] == ID and kinds[1] == ASSIGN:
+        index = 2
+    expect_operand = True
+    # (index, is call) of every '(' not closed yet
+    opened = []
+    while True:
+        kind = kinds[index]
+        if kind is None:
+            report(index, (), 'Invalid character')
+        elif expect_operand:
+            if kind == LPAREN:
+                opened.append((index, False))
+            elif kind == ID and kinds[index + 1] == LPAREN:
+                index += 1
+                opened.append((index, True))
+            elif kind in (INTEGER, ID):
+                expect_operand = False
+            elif kind == PR2:
+                pass
+            elif kind == RPAREN and opened and opened[-1] == (index - 1, True):
+                # a call without arguments
+                opened.pop()
+                expect_operand = False
+            else:
+                # skip it and keep waiting for the operand
+                report(index, _OPERAND, 'Expected a number, name or (')
+        elif kind in _OPERATOR and kind != RPAREN:
+            expect_operand = True
+        elif kind == COMMA and opened and opened[-1][1]:
+            expect_operand = True
+        elif kind == RPAREN:
+            if opened:
+                opened.pop()
+            else:
+                report(index, _OPERATOR[:-1] + (EOF,), 'Unmatched )')
+        elif kind == EOF:
+            pass
+        elif kind in (INTEGER, ID, LPAREN):
+            # assume the operator that is missing and read this operand;
+            # expect_operand is already False for a number or name
+            report(index, expected_operator(), 'Expected an operator or )')
+            if kind == LPAREN:
+                opened.append((index, False))
+                expect_operand = True
+            elif kind == ID and kinds[index + 1] == LPAREN:
+                index += 1
+                opened.append((index, True))
+                expect_operand = True
+        else:
+            report(index, expected_operator(), 'Expected an operator or )')
+        if kind == EOF:
+            break
+        index += 1
+
+    for open_index, _ in opened:
+        diagnostics.append(Diagnostic(line, starts[open_index], '(', (RPAREN,), 'Unclosed ('))
+    diagnostics.sort(key=lambda d: d.position)
+    return diagnostics
+
+
+def validate_lines(lines, statement=False):
+    """Validate newline-delimited expressions; yields every Diagnostic.
+
+    line is the 1-based line number. Blank lines are skipped. The input
+    is read lazily, so files of any size can be checked.
+    """
+    for number, text in enumerate(lines, 1):
+        if text.strip():
+            for diagnostic in validate(text, number, statement):
+                yield diagnostic
+
+
+def evaluate_record(line):
+    """Evaluate one input line and return its output record.
+
+        ok<TAB>22.0
+        error<TAB>Invalid syntax. Token(EOF, None)
+
+    A blank line gives an empty record. Every record ends with a newline.
+    """
+    text = line.strip()
+    if not text:
+        return '\n'
+    try:
+        return 'ok\t{0}\n'.format(compile_cached(text).run())
+    except Exception as e:
+        return 'error\t{0}\n'.format(e)
+
+
+def evaluate_lines(lines, chunk_size=1024):
+    """Evaluate newline-delimited expressions, yielding one chunk at a time.
+
+    Each chunk is a string holding one evaluate_record() per input line,
+    so output line N always belongs to input line N. Only one chunk of
+    input is held in memory at a time.
+    """
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield ''.join([evaluate_record(line) for line in chunk])
+
+
+def run_batch(infile, outfile, chunk_size=1024):
+    """Evaluate every line of infile and write the records to outfile."""
+    for records in evaluate_lines(infile, chunk_size):
+        outfile.write(records)
+
+
+def _evaluate_chunk(texts, env=None):
+    """Evaluate texts in order, putting each error where its result would go."""
+    results = []
+    for text in texts:
+        try:
+            results.append(compile_cached(text).run(env))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def evaluate_many(texts, workers=None, chunk_size=256, env=None):
+    """Evaluate many independent expressions on a pool of processes.
+
+    texts is split into chunks of chunk_size which are handed to workers
+    processes (os.cpu_count() by default); every worker keeps its own
+    compiled-expression cache. The returned list is in input order and
+    holds the result of each expression, or the exception it raised.
+    workers=1 evaluates in the calling process.
+    """
+    texts = iter(texts)
+    chunks = iter(lambda: list(itertools.islice(texts, chunk_size)), [])
+    results = []
+    if workers == 1:
+        for chunk in chunks:
+            results.extend(_evaluate_chunk(chunk, env))
+        return results
+    with ProcessPoolExecutor(workers) as pool:
+        for chunk_results in pool.map(_evaluate_chunk, chunks, itertools.repeat(env)):
+            results.extend(chunk_results)
+    return results
+
+
+class _Failure(object):
+    """Marks a value that could not be computed in a BatchProgram round."""
+
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _SlotAllocator(NodeVisitor):
+    """Number every distinct subexpression of a batch of trees.
+
+    Returns the slot of each tree; structurally equal subtrees, also
+    across trees, get the same slot. + and * are commutative, so x + y
+    and y + x share a slot too. Calls of functions that are not pure
+    are never shared.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.consts = []
+        self.names = []
+        # (slot, opcode, operator or function name, operand slots) in
+        # evaluation order
+        self.steps = []
+        self.nodes = 0
+
+    def _slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = len(self.slots)
+        return slot
+
+    def visit_Num(self, node):
+        self.nodes += 1
+        key = ('const',) + _const_key(node.value)
+        if key not in self.slots:
+            self.consts.append((self._slot(key), node.value))
+        return self.slots[key]
+
+    def visit_Var(self, node):
+        self.nodes += 1
+        key = ('name', node.name)
+        if key not in self.slots:
+            self.names.append((self._slot(key), node.name))
+        return self.slots[key]
+
+    def visit_Group(self, node, inner):
+        return inner
+
+    def _step(self, key, opcode, arg, operands):
+        self.nodes += 1
+        if key not in self.slots:
+            self.steps.append((self._slot(key), opcode, arg, operands))
+        return self.slots[key]
+
+    def visit_UnaryOp(self, node, operand):
+        op = node.op.value
+        return self._step((UNARY_OP, op, operand), UNARY_OP, op, (operand,))
+
+    def visit_Call(self, node, *args):
+        function = lookup_function(node.name, len(args))
+        key = (CALL_FUNCTION, node.name, args)
+        if not function.pure:
+            key += (len(self.slots),)
+        return self._step(key, CALL_FUNCTION, node.name, args)
+
+    def visit_BinOp(self, node, left, right):
+        op = node.op.value
+        if op in ('+', '*') and right < left:
+            left, right = right, left
+        return self._step((op, left, right), BINARY_OP, op, (left, right))
+
+
+class BatchProgram(object):
+    """Many formulas compiled together, sharing common subexpressions.
+
+    >>> batch = BatchProgram(['(a + b) * 2', '(b + a) / 4', 'c - (a + b)'])
+    >>> batch.run({'a': 1, 'b': 3, 'c': 10})
+    [8, 1.0, 6]
+
+    Every distinct subexpression of the whole batch is computed once per
+    run, however many formulas use it. The run itself is one generated
+    Python function of straight-line assignments. If a round fails
+    somewhere, the round is repeated on a checked path, so that only the
+    formulas that depend on the failure get its exception in their
+    result slot, as with evaluate_many().
+    """
+
+    def __init__(self, texts, mode=FLOAT):
+        allocator = _SlotAllocator()
+        self.mode = None
+        roots = []
+        for text in texts:
+            tree = PrecedenceParser(RegexLexer(text)).parse()
+            tree_mode = mode.bind(tree)
+            # EXACT picks INT or FRACTION per tree; a batch needs one mode
+            if self.mode is None or (tree_mode is FRACTION and self.mode is INT):
+                self.mode = tree_mode
+            roots.append(tree)
+        if self.mode is None:
+            self.mode = mode.bind(Num(Token(INTEGER, 0)))
+        optimizer = Optimizer(self.mode)
+        const = self.mode.const
+        self.roots = [allocator.visit(optimizer.optimize(tree)) for tree in roots]
+        self.slot_count = len(allocator.slots)
+        self.consts = [(slot, value if const is None else const(value))
+                       for slot, value in allocator.consts]
+        self.names = allocator.names
+        # (slot, opcode, operator, operand slots, function) per step
+        unary = self.mode.unary
+        self.steps = [(slot, opcode, arg, operands,
+                       self.mode.ops[arg] if opcode == BINARY_OP else
+                       unary[arg] if opcode == UNARY_OP else self.mode.function(arg, len(operands)).fn)
+                      for slot, opcode, arg, operands in allocator.steps]
+        # subexpressions the formulas contain, against those computed
+        self.node_count = allocator.nodes
+        self.computed_count = len(self.consts) + len(self.names) + len(self.steps)
+        self._function = self._lower()
+
+    def _lower(self):
+        namespace = {'__builtins__': {}}
+        infix = self.mode.ops is BINARY_OPS
+        infix_unary = self.mode.unary is UNARY_OPS
+        lines = ['def batch_round(env):']
+        for slot, value in self.consts:
+            literal = _literal(value)
+            if literal is None:
+                literal = '_c{0}'.format(slot)
+                namespace[literal] = value
+            lines.append('    v{0} = {1}'.format(slot, literal))
+        for slot, name in self.names:
+            lines.append('    v{0} = env[{1!r}]'.format(slot, name))
+        for slot, opcode, op, operands, function in self.steps:
+            args = ['v{0}'.format(operand) for operand in operands]
+            if opcode == CALL_FUNCTION:
+                namespace['_g' + op] = function
+                lines.append('    v{0} = _g{1}({2})'.format(slot, op, ', '.join(args)))
+            elif opcode == UNARY_OP and infix_unary:
+                lines.append('    v{0} = {1}{2}'.format(slot, op, args[0]))
+            elif opcode == UNARY_OP:
+                namespace['_u' + _UNARY_NAMES[op]] = function
+                lines.append('    v{0} = _u{1}({2})'.format(slot, _UNARY_NAMES[op], args[0]))
+            elif infix and op in _PY_OPERATORS:
+                lines.append('    v{0} = {1} {2} {3}'.format(slot, args[0], _PY_OPERATORS[op], args[1]))
+            else:
+                namespace['_f' + _OPERATOR_NAMES[op]] = function
+                lines.append('    v{0} = _f{1}({2}, {3})'.format(slot, _OPERATOR_NAMES[op], *args))
+        lines.append('    return [{0}]'.format(', '.join('v{0}'.format(slot) for slot in self.roots)))
+        exec(compile('\n'.join(lines), '<calc6 batch>', 'exec'), namespace)
+        return namespace['batch_round']
+
+    def run(self, env=None):
+        """Evaluate every formula once; returns the results in input order."""
+        try:
+            return self._function(env)
+        except Exception:
+            return self._run_checked(env)
+
+    def _run_checked(self, env):
+        values = [None] * self.slot_count
+        for slot, value in self.consts:
+            values[slot] = value
+        for slot, name in self.names:
+            try:
+                values[slot] = env[name]
+            except (KeyError, TypeError):
+                values[slot] = _Failure(Exception('Undefined variable {0}'.format(name)))
+        for slot, opcode, op, operands, function in self.steps:
+            args = [values[operand] for operand in operands]
+            failure = next((arg for arg in args if isinstance(arg, _Failure)), None)
+            if failure is not None:
+                values[slot] = failure
+            else:
+                try:
+                    values[slot] = function(*args)
+                except Exception as e:
+                    values[slot] = _Failure(e)
+        results = []
+        for slot in self.roots:
+            value = values[slot]
+            results.append(value.error if isinstance(value, _Failure) else value)
+        return results
+
+
 def main():
+    # calc6.py FILE evaluates a file, calc6.py - evaluates stdin,
+    # calc6.py --check FILE reports every syntax error in a file
+    if len(sys.argv) > 2 and sys.argv[1] == '--check':
+        with open(sys.argv[2]) as infile:
+            for d in validate_lines(infile):
+                sys.stdout.write('{0}:{1}: {2}, found {3}\n'.format(
+                    d.line, d.position + 1, d.message, d.found))
+        return
+    if len(sys.argv) > 1:
+        if sys.argv[1] == '-':
+            run_batch(sys.stdin, sys.stdout)
+        else:
+            with open(sys.argv[1]) as infile:
+                run_batch(infile, sys.stdout)
+        return
+
+    sheet = Sheet()
     while True:
         try:
             text = input('calc> ')
@@ -181,9 +2681,7 @@ def main():
                 break;
             if not text:
                 continue  
-            lexer = Lexer(text)
-            interpreter = Interpreter(lexer)
-            result = interpreter.expr()
+            result = sheet.execute(text)
             print(result)
         except Exception as e:
             print(e)
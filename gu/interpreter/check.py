@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+' Randomized equivalence checks for the calc6 engine '
+
+# usage: python check.py [--count N] [--seed N] [CHECK ...]
+#
+# Every check generates random input, runs it through two code paths
+# that must agree and stops at the first mismatch, printing the input:
+#
+#   $ python check.py --count 5000 parsers
+#   parsers      5000 inputs  ok
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import calc6
+
+ATOMS = ['0', '1', '2', '3', '12', 'x', 'y']
+FUNCTIONS = [('min', None), ('max', None), ('abs', 1), ('sqrt', 1)]
+# pieces spliced into expressions to make them invalid
+NOISE = ['1', 'x', '-', '+', '*', '/', '^', '(', ')', ',', 'max', ' ', '$', '=']
+ENV = {'x': 3, 'y': -2}
+
+
+def expression(rnd, depth=0):
+    """A random, usually valid, expression."""
+    r = rnd.random()
+    if depth > 4 or r < 0.3:
+        return rnd.choice(ATOMS)
+    if r < 0.4:
+        return rnd.choice('-+') + expression(rnd, depth + 1)
+    if r < 0.5:
+        name, arity = rnd.choice(FUNCTIONS)
+        count = arity or rnd.randint(1, 3)
+        return '{0}({1})'.format(name, ', '.join(expression(rnd, depth + 1) for _ in range(count)))
+    if r < 0.6:
+        return '(' + expression(rnd, depth + 1) + ')'
+    if r < 0.65:
+        # small exponents only, 3^3^3^3 would never finish
+        return expression(rnd, depth + 1) + '^' + rnd.choice(ATOMS)
+    return expression(rnd, depth + 1) + rnd.choice([' + ', '-', '*', ' / ']) + expression(rnd, depth + 1)
+
+
+def mutate(rnd, text):
+    """text with a few characters deleted or some noise inserted."""
+    index = rnd.randint(0, len(text))
+    if text and rnd.random() < 0.5:
+        return text[:index] + text[index + rnd.randint(1, 3):]
+    return text[:index] + rnd.choice(NOISE) + text[index:]
+
+
+def soup(rnd):
+    """Random input: a valid expression, a damaged one, or plain noise."""
+    r = rnd.random()
+    if r < 0.1:
+        return ''.join(rnd.choice(NOISE) for _ in range(rnd.randint(0, 8)))
+    text = expression(rnd)
+    while r > 0.4 and rnd.random() < 0.6:
+        text = mutate(rnd, text)
+    return text
+
+
+def outcome(evaluate):
+    """Result of evaluate(), or the error it raised, in comparable form."""
+    try:
+        value = evaluate()
+    except Exception as e:
+        return ('error', str(e))
+    if isinstance(value, float):
+        if value != value:
+            return ('ok', 'nan')
+        # results of different groupings agree to rounding only
+        return ('ok', value if value in (float('inf'), float('-inf')) else round(value, 6))
+    return ('ok', value)
+
+
+def check_parsers(rnd, count):
+    """PrecedenceParser and the recursive descent Parser build the same trees."""
+    for _ in range(count):
+        text = soup(rnd)
+        if text.count('^') > 2:
+            continue
+        fast = outcome(lambda: calc6.compile_expr(text, optimize=False).run(ENV))
+        slow = outcome(lambda: calc6.compile_expr(text, optimize=False, parser=calc6.Parser).run(ENV))
+        if fast != slow:
+            raise AssertionError('{0!r}: {1} != {2}'.format(text, fast, slow))
+
+
+def check_documents(rnd, count):
+    """A Document edited step by step matches parsing its final text."""
+    for _ in range(count):
+        text = original = soup(rnd)
+        doc = calc6.Document(text)
+        for _ in range(rnd.randint(1, 4)):
+            # replace a random slice of text with a random piece of another input
+            new = soup(rnd)
+            start = rnd.randint(0, len(text))
+            end = rnd.randint(start, len(text))
+            piece = new[rnd.randint(0, len(new)):][:rnd.randint(0, 6)]
+            doc.edit(start, end - start, piece)
+            text = text[:start] + piece + text[end:]
+            if text.count('^') > 2:
+                break
+            whole = outcome(lambda: calc6.compile_expr(text).run(ENV))
+            edited = outcome(lambda: doc.program().run(ENV))
+            # bad input may be reported at a different token
+            if whole[0] == edited[0] == 'error':
+                continue
+            if whole != edited:
+                raise AssertionError('{0!r} edited into {1!r}: {2} != {3}'.format(
+                    original, text, edited, whole))
+
+
+def check_validate(rnd, count):
+    """validate() reports no errors exactly for the text the parser accepts."""
+    for _ in range(count):
+        text = soup(rnd)
+        try:
+            calc6.PrecedenceParser(calc6.RegexLexer(text)).parse()
+            error = None
+        except Exception as e:
+            error = e
+        diagnostics = calc6.validate(text)
+        if bool(diagnostics) != (error is not None):
+            raise AssertionError('{0!r}: parser says {1}, validate says {2}'.format(
+                text, error or 'ok', diagnostics or 'ok'))
+
+
+# constants the lowered code must bind as names rather than spell out
+JIT_REGRESSIONS = ['x + (1/1)*10^308*10', 'x - (1/1)*10^308*10*0', 'x + 10^5000',
+                   '((0-1)*(0/1))^2 + x']
+# constants that compare equal but must not be merged
+SIGNED_ZEROS = ['(0-1)*(0/1)', '0/1', 'x*0 + (0-1)*(0/1)', 'max(0/1, (0-1)*(0/1))']
+
+
+def check_jit(rnd, count):
+    """Programs give the same results after JIT_THRESHOLD runs as before."""
+    for index in range(count):
+        text = JIT_REGRESSIONS[index] if index < len(JIT_REGRESSIONS) else expression(rnd)
+        if text.count('^') > 2:
+            continue
+        try:
+            program = calc6.compile_expr(text)
+        except Exception:
+            continue
+        interpreted = outcome(lambda: program.run(ENV, ops=program.mode.ops))
+        for _ in range(calc6.JIT_THRESHOLD + 1):
+            native = outcome(lambda: program.run(ENV))
+        if native != interpreted:
+            raise AssertionError('{0!r}: {1} != {2}'.format(text, native, interpreted))
+
+
+def check_batch(rnd, count):
+    """A BatchProgram round computes what its formulas give one by one.
+
+    The generated round function is called directly: run() would hide
+    a round that fails by repeating it on the checked path.
+    """
+    for index in range(count // 10):
+        texts = [text for text in (expression(rnd) for _ in range(10)) if text.count('^') <= 2]
+        if index == 0:
+            texts += JIT_REGRESSIONS
+        texts = [text for text in texts if outcome(lambda: calc6.compile_expr(text).run(ENV))[0] == 'ok']
+        batch = calc6.BatchProgram(texts)
+        results = [outcome(lambda: value) for value in batch._function(ENV)]
+        for text, result in zip(texts, results):
+            single = outcome(lambda: calc6.compile_expr(text).run(ENV))
+            if result != single:
+                raise AssertionError('{0!r}: {1} != {2}'.format(text, result, single))
+    # outcome() rounds and 0.0 == -0.0, so compare these exactly
+    batch = calc6.BatchProgram(SIGNED_ZEROS)
+    for text, result in zip(SIGNED_ZEROS, batch._function(ENV)):
+        single = calc6.compile_expr(text).run(ENV)
+        if repr(result) != repr(single):
+            raise AssertionError('{0!r}: {1!r} != {2!r}'.format(text, result, single))
+
+
+def check_library(rnd, count):
+    """Programs read back from a library file give the same results."""
+    texts = ['x + 10^200000', 'v' * 70000 + ' + x']
+    texts += [text for text in (expression(rnd) for _ in range(count)) if text.count('^') <= 2]
+    modes = [calc6.FLOAT, calc6.EXACT, calc6.DecimalMode(prec=12)]
+    programs = []
+    for text in texts:
+        try:
+            programs.append((text, calc6.compile_expr(text, mode=rnd.choice(modes))))
+        except Exception:
+            pass
+    # only the whole context tells an overflow from a result
+    programs.append(('x * 10^4', calc6.compile_expr('x * 10^4', mode=calc6.DecimalMode(
+        prec=5, Emax=3, traps=[calc6.decimal.Overflow]))))
+    env = dict(ENV, **{'v' * 70000: 1})
+    fd, path = tempfile.mkstemp(suffix='.lib')
+    os.close(fd)
+    try:
+        calc6.save_library(path, dict((str(index), program) for index, (_, program) in enumerate(programs)))
+        with calc6.Library(path) as library:
+            for index, (text, program) in enumerate(programs):
+                if isinstance(program.mode, calc6.DecimalMode):
+                    values = dict((name, program.mode.context.create_decimal(value))
+                                  for name, value in env.items())
+                else:
+                    values = env
+                loaded = outcome(lambda: library[str(index)].run(values))
+                if loaded != outcome(lambda: program.run(values)):
+                    raise AssertionError('{0!r}: {1} after loading'.format(text[:80], loaded))
+    finally:
+        os.remove(path)
+
+
+CHECKS = [
+    ('parsers', check_parsers),
+    ('documents', check_documents),
+    ('validate', check_validate),
+    ('jit', check_jit),
+    ('batch', check_batch),
+    ('library', check_library),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000, help='inputs per check')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated inputs')
+    parser.add_argument('checks', nargs='*', help='checks to run (all by default)')
+    args = parser.parse_args()
+
+    failed = False
+    for name, check in CHECKS:
+        if args.checks and name not in args.checks:
+            continue
+        try:
+            check(random.Random(args.seed), args.count)
+            print('{0:<12}{1:>6} inputs  ok'.format(name, args.count))
+        except AssertionError as e:
+            print('{0:<12}FAILED  {1}'.format(name, e))
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+' Serve the calc6 engine over TCP or a Unix socket with asyncio '
+
+# usage: python server.py [--host HOST] [--port PORT] [--unix PATH] [--limit BYTES]
+#                         [--workers N] [--timeout SECONDS]
+#
+# Clients send newline-delimited expressions and get back one
+# calc6.evaluate_record() line per expression, in the order sent:
+#
+#   $ printf '1 + 2\n(3\n' | nc localhost 8888
+#   ok      3
+#   error   Invalid syntax. Token(EOF, None)
+#
+# A client may send many expressions without waiting for the answers.
+# Expressions from all connections are evaluated in micro-batches, on a
+# pool of worker processes, so a slow expression does not hold up the
+# event loop. A batch that runs past the timeout is answered with
+# errors. A line longer than the limit is answered with an error
+# record and skipped; the connection stays open.
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import calc6
+
+# stands in for a line that was over the limit
+_TOO_LONG = object()
+
+
+def evaluate_records(texts):
+    """Evaluate one batch in a worker process: a record per text."""
+    return [calc6.evaluate_record(text) for text in texts]
+
+
+class CalcServer(object):
+
+    def __init__(self, batch_size=256, batch_delay=0.0005, max_pending=1024, line_limit=2 ** 16,
+                 workers=None, timeout=10.0):
+        # at most batch_size expressions are evaluated in one go
+        self.batch_size = batch_size
+        # how long a batch waits for more work once the first line arrives
+        self.batch_delay = batch_delay
+        # unanswered expressions per connection before reading pauses
+        self.max_pending = max_pending
+        # longest line in bytes a client may send; the streams' buffer limit
+        self.line_limit = line_limit
+        # worker processes (os.cpu_count() by default), which is also the
+        # number of batches evaluated at once
+        self.workers = workers or os.cpu_count() or 1
+        # seconds a batch may take before its expressions get an error
+        self.timeout = timeout
+        self.queue = None
+        self._batcher = None
+        self._pool = None
+
+    async def start(self, host='127.0.0.1', port=8888, path=None):
+        """Start listening; returns the asyncio server."""
+        self.queue = asyncio.Queue()
+        self._pool = self._new_pool()
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path, limit=self.line_limit)
+        return await asyncio.start_server(self.handle, host, port, limit=self.line_limit)
+
+    def _new_pool(self):
+        # workers start on demand; forked ones would inherit the sockets
+        # of open connections and keep them from ever closing
+        return ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'))
+
+    def close(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _drain_queue(self, batch):
+        queue = self.queue
+        while len(batch) < self.batch_size and not queue.empty():
+            batch.append(queue.get_nowait())
+
+    async def _run_batches(self):
+        queue = self.queue
+        # one slot per worker, so that batches wait here rather than
+        # behind a slow batch inside the pool
+        slots = asyncio.Semaphore(self.workers)
+        while True:
+            batch = [await queue.get()]
+            self._drain_queue(batch)
+            if len(batch) < self.batch_size and self.batch_delay > 0:
+                # let other connections add to this batch
+                await asyncio.sleep(self.batch_delay)
+                self._drain_queue(batch)
+            await slots.acquire()
+            task = asyncio.ensure_future(self._evaluate(batch))
+            task.add_done_callback(lambda task: slots.release())
+
+    async def _evaluate(self, batch):
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            records = await asyncio.wait_for(
+                loop.run_in_executor(pool, evaluate_records, [text for text, future in batch]),
+                self.timeout)
+        except asyncio.TimeoutError:
+            # the worker is left to finish; the batch is answered now
+            records = ['error\tTimed out after {0} s\n'.format(self.timeout)] * len(batch)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool) and pool is self._pool:
+                # a worker died and the pool takes no more work
+                pool.shutdown(wait=False)
+                self._pool = self._new_pool()
+            # one line, as records are lines
+            records = ['error\t{0}\n'.format(' '.join(str(e).split()))] * len(batch)
+        for (text, future), record in zip(batch, records):
+            if not future.cancelled():
+                future.set_result(record)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        # futures in the order their lines arrived; bounded so that a
+        # client that never reads its answers cannot queue up unbounded work
+        responses = asyncio.Queue(self.max_pending)
+        write_task = asyncio.ensure_future(self._write_responses(responses, writer))
+        try:
+            while not write_task.done():
+                line = await self._read_line(reader)
+                if not line:
+                    break
+                future = loop.create_future()
+                if line is _TOO_LONG:
+                    future.set_result('error\tLine longer than {0} bytes\n'.format(self.line_limit))
+                else:
+                    self.queue.put_nowait((line.decode('utf-8', 'replace'), future))
+                await responses.put(future)
+        except ConnectionError:
+            pass
+        finally:
+            if not write_task.done():
+                await responses.put(None)
+            try:
+                await write_task
+            except ConnectionError:
+                pass
+            writer.close()
+
+    @staticmethod
+    async def _read_line(reader):
+        """Return the next line, b'' at the end, or _TOO_LONG.
+
+        Unlike readline(), which fails on a line over the stream's limit
+        and may leave the rest of it behind, this drops such a line up to
+        and including its newline, so the lines after it are still read.
+        """
+        line = None
+        while True:
+            try:
+                chunk = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                # the last line had no newline
+                chunk = e.partial
+            except asyncio.LimitOverrunError as e:
+                # drop what is buffered so far and keep looking for the end
+                await reader.readexactly(e.consumed)
+                line = _TOO_LONG
+                continue
+            return chunk if line is None else line
+
+    async def _write_responses(self, responses, writer):
+        while True:
+            future = await responses.get()
+            if future is None:
+                break
+            writer.write((await future).encode('utf-8'))
+            # flush once per burst of ready answers instead of once per line
+            if responses.empty():
+                await writer.drain()
+        await writer.drain()
+
+
+async def serve(host, port, path, line_limit, workers, timeout):
+    server = CalcServer(line_limit=line_limit, workers=workers, timeout=timeout)
+    listener = await server.start(host, port, path)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='calc6 expression server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--unix', help='listen on this Unix socket path instead of TCP')
+    parser.add_argument('--limit', type=int, default=2 ** 16, help='longest accepted line in bytes')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds a batch may take')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.limit, args.workers, args.timeout))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
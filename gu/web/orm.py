@@ -3,24 +3,345 @@
 
 ' Simple ORM using metaclass '
 
+import contextlib
+import itertools
+import operator
+import sqlite3
+import threading
+import time
+
 class Field(object):
 
-    def __init__(self, name, column_type):
+    def __init__(self, name, column_type, primary_key=False):
         self.name = name
         self.column_type = column_type
+        self.primary_key = primary_key
 
     def __str__(self):
         return '<%s:%s>' % (self.__class__.__name__, self.name)
 
 class StringField(Field):
 
-    def __init__(self, name):
-        super(StringField, self).__init__(name, 'varchar(100)')
+    def __init__(self, name, primary_key=False):
+        super(StringField, self).__init__(name, 'varchar(100)', primary_key)
 
 class IntegerField(Field):
 
-    def __init__(self, name):
-        super(IntegerField, self).__init__(name, 'bigint')
+    def __init__(self, name, primary_key=False):
+        super(IntegerField, self).__init__(name, 'bigint', primary_key)
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool(object):
+    '''
+    A bounded set of DB-API connections shared by many threads.
+
+    min_size connections are opened up front and kept; at most max_size
+    are open at once. acquire() waits up to timeout seconds for a free
+    connection, then raises PoolTimeout. A connection that has been idle
+    for more than check_after seconds is checked with check() before it
+    is handed out and replaced if it fails; idle connections beyond
+    min_size are closed after max_idle seconds.
+
+    A thread that already holds a connection gets the same one back from
+    acquire(), so nested use (a save() while iterating a query) never
+    waits on the pool or deadlocks it.
+    '''
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30.0, check_after=60.0, max_idle=600.0):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('Invalid pool size: min %s, max %s' % (min_size, max_size))
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+        # (connection, time of release), most recently used last
+        self._idle = []
+        # thread ident -> [connection, nesting depth, broken]
+        self._held = {}
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        for _ in range(min_size):
+            self._idle.append((connect(), time.monotonic()))
+            self._size += 1
+
+    @property
+    def size(self):
+        ' Number of open connections, idle or in use. '
+        return self._size
+
+    def check(self, connection):
+        ' True if connection still works. '
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('select 1')
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        ident = threading.get_ident()
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            held = self._held.get(ident)
+            if held is not None:
+                held[1] += 1
+                return held[0]
+            while True:
+                if self._closed:
+                    raise RuntimeError('Connection pool is closed')
+                if self._idle:
+                    connection, since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # reserve the slot, connect outside the lock
+                    self._size += 1
+                    connection = since = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout('No connection available within %s seconds' % timeout)
+                self._cond.wait(remaining)
+        try:
+            if connection is None:
+                connection = self.connect()
+            elif time.monotonic() - since > self.check_after and not self.check(connection):
+                self._close(connection)
+                connection = self.connect()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._held[ident] = [connection, 1, False]
+        return connection
+
+    def release(self, connection, broken=False, ident=None):
+        '''
+        Give back a connection taken by the thread ident (this thread by
+        default). A broken connection is closed instead of reused.
+        '''
+        ident = threading.get_ident() if ident is None else ident
+        expired = []
+        with self._cond:
+            held = self._held[ident]
+            held[1] -= 1
+            held[2] = held[2] or broken
+            if held[1]:
+                return
+            del self._held[ident]
+            now = time.monotonic()
+            if held[2] or self._closed:
+                self._size -= 1
+                expired.append(connection)
+            else:
+                self._idle.append((connection, now))
+                while self._size > self.min_size and now - self._idle[0][1] > self.max_idle:
+                    expired.append(self._idle.pop(0)[0])
+                    self._size -= 1
+            self._cond.notify()
+        for connection in expired:
+            self._close(connection)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None, broken_on=()):
+        '''
+        with pool.connection() as connection: ...
+
+        An exception of one of the broken_on types marks the connection
+        as broken.
+        '''
+        connection = self.acquire(timeout)
+        ident = threading.get_ident()
+        broken = False
+        try:
+            yield connection
+        except broken_on:
+            broken = True
+            raise
+        finally:
+            # may run in another thread if a generator using it is abandoned
+            self.release(connection, broken, ident)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        ' Close the idle connections; those in use are closed when released. '
+        with self._cond:
+            self._closed = True
+            idle = [connection for connection, _ in self._idle]
+            self._size -= len(idle)
+            self._idle = []
+            self._cond.notify_all()
+        for connection in idle:
+            self._close(connection)
+
+class Backend(object):
+    '''
+    Run the SQL of the models through a DB-API 2.0 module.
+
+    Connections come from a ConnectionPool; the keyword arguments
+    min_size, max_size, timeout, check_after and max_idle configure it,
+    everything else is passed to module.connect().
+
+    The models write their SQL with ? placeholders; it is rewritten once
+    per statement for modules with another paramstyle and the rewritten
+    text is reused, so drivers that cache prepared statements by SQL text
+    (as sqlite3 does) keep hitting their cache.
+    '''
+
+    # ? -> placeholder of the module's paramstyle
+    PLACEHOLDERS = {
+        'qmark': lambda i: '?',
+        'format': lambda i: '%s',
+        'numeric': lambda i: ':%d' % i,
+    }
+
+    POOL_OPTIONS = ('min_size', 'max_size', 'timeout', 'check_after', 'max_idle')
+
+    def __init__(self, module, *args, **kw):
+        if module.paramstyle not in self.PLACEHOLDERS:
+            raise ValueError('Unsupported paramstyle: %s' % module.paramstyle)
+        self.module = module
+        options = dict((k, kw.pop(k)) for k in self.POOL_OPTIONS if k in kw)
+        self.pool = ConnectionPool(lambda: module.connect(*args, **kw), **options)
+        self._statements = {}
+
+    def prepare(self, sql):
+        statement = self._statements.get(sql)
+        if statement is None:
+            placeholder = self.PLACEHOLDERS[self.module.paramstyle]
+            parts = sql.split('?')
+            statement = parts[0] + ''.join(placeholder(i) + part for i, part in enumerate(parts[1:], 1))
+            self._statements[sql] = statement
+        return statement
+
+    def connection(self):
+        ' Check out a pooled connection; an InterfaceError marks it broken. '
+        return self.pool.connection(broken_on=self.module.InterfaceError)
+
+    def execute(self, sql, args=()):
+        ' Run one statement in its own transaction, returns the row count. '
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(self.prepare(sql), args)
+                connection.commit()
+                return cursor.rowcount
+            except BaseException:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def executemany(self, sql, rows):
+        ' Run sql once per args in rows, all in one transaction. '
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.executemany(self.prepare(sql), rows)
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def select(self, sql, args=()):
+        ' Run a query, returns all rows. '
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(self.prepare(sql), args)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    def stream_cursor(self, connection):
+        '''
+        Cursor for stream(). sqlite3 steps through the result as rows are
+        fetched; backends whose driver buffers the whole result on the
+        client should return a server-side (named) cursor here.
+        '''
+        return connection.cursor()
+
+    def stream(self, sql, args=(), batch_size=1000):
+        '''
+        Run a query and yield its rows, fetching batch_size rows at a time.
+        The connection stays checked out until the rows run out or the
+        generator is closed.
+        '''
+        with self.connection() as connection:
+            cursor = self.stream_cursor(connection)
+            try:
+                cursor.execute(self.prepare(sql), args)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+
+    def close(self):
+        self.pool.close()
+
+class SQLiteBackend(Backend):
+    '''
+    Backend on the stdlib sqlite3 module.
+
+    Pooled connections move between threads, so they are opened with
+    check_same_thread=False. An in-memory database exists only inside its
+    one connection, so for ':memory:' the pool holds exactly one.
+    '''
+
+    def __init__(self, database=':memory:', **kw):
+        kw.setdefault('check_same_thread', False)
+        if database == ':memory:':
+            kw.update(min_size=1, max_size=1)
+        super(SQLiteBackend, self).__init__(sqlite3, database, **kw)
+
+_backend = None
+
+def set_backend(backend):
+    ' Make every model read and write through backend, returns it. '
+    global _backend
+    _backend = backend
+    return backend
+
+def get_backend():
+    if _backend is None:
+        raise RuntimeError('No database backend, call set_backend() first')
+    return _backend
+
+def _make_init(fields):
+    '''
+    Build __init__(self, f1=None, f2=None, ...) for the given fields.
+
+    Like namedtuple, the code is generated, so setting the fields costs
+    one slot store each and unknown keywords fail as for any function.
+    '''
+    source = 'def __init__(self%s):%s' % (
+        ''.join(', %s=None' % k for k in fields),
+        ''.join('\n    self.%s = %s' % (k, k) for k in fields) or '\n    pass')
+    namespace = {}
+    exec(source, namespace)
+    return namespace['__init__']
 
 class ModelMetaclass(type):
 
@@ -29,49 +350,250 @@ class ModelMetaclass(type):
             return type.__new__(cls, name, bases, attrs)
         print('Found model: %s' % name)
         mappings = dict()
+        # fields of a model class are inherited by its subclasses
+        for base in reversed(bases):
+            mappings.update(getattr(base, '__mappings__', {}))
+        inherited = set(mappings)
+        primary_key = None
         for k, v in attrs.items():
             if isinstance(v, Field):
                 print('Found mapping: %s ==> %s' % (k, v))
                 mappings[k] = v
+        for k, v in mappings.items():
+            if v.primary_key:
+                if primary_key is not None:
+                    raise TypeError('Duplicate primary key for field: %s' % k)
+                primary_key = k
         for k in mappings.keys():
-            attrs.pop(k)
+            attrs.pop(k, None)
+        # 每个字段一个slot, 实例没有__dict__; 类上的slot描述符就是字段的访问器
+        attrs['__slots__'] = tuple(k for k in mappings if k not in inherited)
+        fields = tuple(mappings.keys())
+        attrs.setdefault('__init__', _make_init(fields))
+        # __values__(obj) -> tuple of the field values, in column order
+        attrs['__values__'] = staticmethod(operator.attrgetter(*fields) if len(fields) > 1 else
+                                           lambda obj: tuple(getattr(obj, k) for k in fields))
         attrs['__mappings__'] = mappings # 保存属性和列的映射关系
         attrs['__table__'] = name # 假设表名和类名一致
+        attrs['__fields__'] = fields
+        attrs['__primary_key__'] = primary_key
+        # 每个模型的SQL只生成一次, 之后每次调用直接复用
+        columns = ','.join(f.name for f in mappings.values())
+        attrs['__insert__'] = 'insert into %s (%s) values (%s)' % (name, columns, ','.join('?' * len(mappings)))
+        attrs['__select__'] = 'select %s from %s' % (columns, name)
+        attrs['__find__'] = None
+        if primary_key is not None:
+            attrs['__find__'] = '%s where %s=?' % (attrs['__select__'], mappings[primary_key].name)
+        attrs['__create__'] = 'create table if not exists %s (%s)' % (name, ','.join(
+            '%s %s%s' % (f.name, f.column_type, ' primary key' if f.primary_key else '')
+            for f in mappings.values()))
         return type.__new__(cls, name, bases, attrs)
 
-class Model(dict, metaclass=ModelMetaclass):
+class Query(object):
+    '''
+    A SELECT on one model, built up step by step and run lazily.
+
+    >>> for u in User.where(name='Michael').order_by('-id').limit(10):
+    ...     print(u.email)
+
+    Every step returns a new Query. Nothing is sent to the database until
+    the query is iterated; rows are then streamed from the cursor in
+    batches and turned into model objects one at a time, so a query never
+    holds more than one batch of rows.
+    '''
+
+    def __init__(self, model, conditions=(), args=(), order=(), limit=None, offset=None):
+        self.model = model
+        self.conditions = conditions
+        self.args = args
+        self.order = order
+        self._limit = limit
+        self._offset = offset
 
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+    def _copy(self, **kw):
+        state = dict(conditions=self.conditions, args=self.args, order=self.order,
+                     limit=self._limit, offset=self._offset)
+        state.update(kw)
+        return Query(self.model, **state)
 
-    def __getattr__(self, key):
+    def _column(self, field):
         try:
-            return self[key]
+            return self.model.__mappings__[field].name
         except KeyError:
-            raise AttributeError(r"'Model' object has no attribute '%s'" % key)
+            raise ValueError('Unknown field: %s' % field)
+
+    def where(self, clause=None, *args, **kw):
+        '''
+        Add conditions, all of which must hold.
+
+        where(name='Michael') compares fields with values (None is matched
+        with "is null"); where('id > ?', 100) adds an SQL fragment with its
+        arguments.
+        '''
+        conditions = list(self.conditions)
+        values = list(self.args)
+        if clause is not None:
+            conditions.append('(%s)' % clause)
+            values.extend(args)
+        for field, value in kw.items():
+            if value is None:
+                conditions.append('%s is null' % self._column(field))
+            else:
+                conditions.append('%s=?' % self._column(field))
+                values.append(value)
+        return self._copy(conditions=tuple(conditions), args=tuple(values))
+
+    def order_by(self, *fields):
+        ' Sort by fields, a leading - sorts that field in descending order. '
+        order = tuple('%s desc' % self._column(f[1:]) if f.startswith('-') else self._column(f)
+                      for f in fields)
+        return self._copy(order=self.order + order)
+
+    def limit(self, count, offset=None):
+        return self._copy(limit=count, offset=offset)
+
+    def sql(self):
+        ' Return (sql, args) of the query. '
+        sql = [self.model.__select__]
+        args = list(self.args)
+        if self.conditions:
+            sql.append('where %s' % ' and '.join(self.conditions))
+        if self.order:
+            sql.append('order by %s' % ','.join(self.order))
+        if self._limit is not None:
+            sql.append('limit ?')
+            args.append(self._limit)
+            if self._offset is not None:
+                sql.append('offset ?')
+                args.append(self._offset)
+        return ' '.join(sql), args
+
+    def iterate(self, batch_size=1000):
+        ' Yield the matching objects, fetching batch_size rows at a time. '
+        model = self.model
+        sql, args = self.sql()
+        for row in get_backend().stream(sql, args, batch_size):
+            yield model(*row)
+
+    def __iter__(self):
+        return self.iterate()
+
+    def first(self):
+        for obj in self.limit(1, self._offset).iterate(1):
+            return obj
+        return None
+
+class Model(object, metaclass=ModelMetaclass):
+    '''
+    Base class of the models.
+
+    Instances keep their field values in __slots__ generated from the
+    fields, not in a dict, so a loaded row costs about as much memory as
+    a tuple of its values. Fields that are not given are None.
+    '''
+
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.__values__(self) == other.__values__(other)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (k, getattr(self, k)) for k in self.__fields__))
+
+    @classmethod
+    def create_table(cls):
+        get_backend().execute(cls.__create__)
+
+    @classmethod
+    def find(cls, pk):
+        ' Find object by primary key, None if there is no such row. '
+        if cls.__find__ is None:
+            raise TypeError('%s has no primary key' % cls.__name__)
+        rows = get_backend().select(cls.__find__, (pk,))
+        if not rows:
+            return None
+        return cls(*rows[0])
+
+    @classmethod
+    def find_all(cls):
+        return list(cls.query())
+
+    @classmethod
+    def query(cls):
+        ' A Query over all rows of the model. '
+        return Query(cls)
+
+    @classmethod
+    def where(cls, clause=None, *args, **kw):
+        return Query(cls).where(clause, *args, **kw)
+
+    @classmethod
+    def order_by(cls, *fields):
+        return Query(cls).order_by(*fields)
+
+    @classmethod
+    def limit(cls, count, offset=None):
+        return Query(cls).limit(count, offset)
+
+    @classmethod
+    def bulk_save(cls, rows, chunk_size=1000):
+        '''
+        Insert model objects or dicts of field values with executemany.
+        Dicts are keyed by attribute name; other keys raise TypeError.
+
+        rows is read lazily, chunk_size rows at a time, and every chunk is
+        written in a transaction of its own; a failing chunk is rolled back
+        and raised, the chunks before it stay written. Returns the number
+        of rows inserted.
+        '''
+        backend = get_backend()
+        fields = cls.__fields__
+        known = frozenset(fields)
+        values = cls.__values__
+
+        def row_values(row):
+            if isinstance(row, Model):
+                return values(row)
+            # as the constructor does, rather than inserting NULL for a typo
+            unknown = row.keys() - known
+            if unknown:
+                raise TypeError('Unknown fields for %s: %s' % (cls.__name__, ', '.join(sorted(unknown))))
+            return [row.get(k) for k in fields]
+
+        rows = iter(rows)
+        count = 0
+        while True:
+            chunk = [row_values(row) for row in itertools.islice(rows, chunk_size)]
+            if not chunk:
+                return count
+            backend.executemany(cls.__insert__, chunk)
+            count += len(chunk)
 
-    def __setattr__(self, key, value):
-        self[key] = value
+    insert_many = bulk_save
 
     def save(self):
-        fields = []
-        params = []
-        args = []
-        for k, v in self.__mappings__.items():
-            fields.append(v.name)
-            params.append('?')
-            args.append(getattr(self, k, None))
-        sql = 'insert into %s (%s) values (%s)' % (self.__table__, ','.join(fields), ','.join(params))
-        print('SQL: %s' % sql)
-        print('ARGS: %s' % str(args))
+        get_backend().execute(self.__insert__, self.__values__(self))
 
 # testing code:
 
 class User(Model):
-    id = IntegerField('id')
+    id = IntegerField('id', primary_key=True)
     name = StringField('username')
     email = StringField('email')
     password = StringField('password')
 
-u = User(id=12345, name='Michael', email='test@orm.org', password='my-pwd')
-u.save()
\ No newline at end of file
+if __name__ == '__main__':
+    set_backend(SQLiteBackend())
+    User.create_table()
+    u = User(id=12345, name='Michael', email='test@orm.org', password='my-pwd')
+    u.save()
+    print('SQL: %s' % User.__insert__)
+    print('Found: %s' % User.find(12345))
+    User.insert_many(({'id': i, 'name': 'user%d' % i} for i in range(10000)), chunk_size=500)
+    User.bulk_save([User(id=20000, name='Bob', email='bob@orm.org', password='pwd')])
+    print('Rows: %d' % len(User.find_all()))
+    for u in User.where('id < ?', 5).where(email=None).order_by('-id').limit(3):
+        print(u)